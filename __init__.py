@@ -1,5 +1,9 @@
 __version__ = '0.1'
-from chorospy.chorospy.rasterFunc import getValuesAtPoint, getRasterValues, raster2array, array2raster, createRaster, filterByCoverage, clipRaster
+from chorospy.chorospy.rasterFunc import RasterStack, getValuesAtPoint, getRasterValues, raster2array, array2raster, writeRaster, tiffOptions, createRaster, filterByCoverage, coverageFraction, clipRaster, clipRasters, zonalStats
 from chorospy.chorospy.vectorFunc import pointToGeo, disaggregate, createFishNet
 from chorospy.chorospy.bioFunc import makeDensityRaster
-from chorospy.chorospy.transFunc import rasterToJSON, reprojectPoint
\ No newline at end of file
+from chorospy.chorospy.transFunc import rasterToJSON, rasterToTiles, reprojectPoint, reprojectPoints, coordinateTransform
+from chorospy.chorospy.cacheFunc import openRaster, rasterInfo, mapRaster, prefetchRasters, clearCache, setCacheSize, cacheStats
+from chorospy.chorospy.maskFunc import vectorMask, clearMaskCache, setMaskCacheSize, setMaskStore, maskCacheStats
+from chorospy.chorospy.blockFunc import Block, rasterBlocks, mapBlocks, mapRasters, mergeBlocks
+from chorospy.chorospy.profileFunc import profiling, profileStage, profileReport, enableProfiling, disableProfiling, addProfileHook, removeProfileHook
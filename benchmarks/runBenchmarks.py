@@ -0,0 +1,267 @@
+#########################################
+# benchmark suite of the main chorospy functions
+# synthetic, deterministic fixtures (GeoTIFFs, polygon layers and occurrence tables) are generated
+# locally at several sizes, every function is timed (best of --repeat runs) and memory profiled,
+# and the results are written to a json file so that runs can be compared across commits
+#
+# python benchmarks/runBenchmarks.py --sizes small medium --out results.json
+# python benchmarks/runBenchmarks.py --compare old.json new.json
+#########################################
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+import pandas
+from osgeo import gdal, ogr, osr
+
+# run against the working tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chorospy import rasterFunc, vectorFunc, bioFunc, transFunc, cacheFunc, maskFunc
+
+WGS84 = '+proj=longlat +datum=WGS84 +no_defs'
+
+# raster cells per side, number of occurrences and number of polygons per size
+SIZES = {'small': {'cells': 500, 'points': 10000, 'polygons': 10},
+         'medium': {'cells': 2000, 'points': 100000, 'polygons': 50},
+         'large': {'cells': 6000, 'points': 1000000, 'polygons': 200}}
+
+# extent of all fixtures (degrees)
+XMIN, YMIN, XMAX, YMAX = 10., 40., 30., 60.
+
+#########################################
+# fixtures
+#########################################
+def makeRaster(path, cells, seed, dataType = gdal.GDT_Float32, creationOptions = ['TILED=YES']):
+    rng = numpy.random.default_rng(seed)
+    pixelSize = (XMAX - XMIN) / cells
+    ds = gdal.GetDriverByName('GTiff').Create(path, cells, cells, 1, dataType, creationOptions)
+    ds.SetGeoTransform((XMIN, pixelSize, 0, YMAX, 0, -pixelSize))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    # a smooth field with noise and some nodata cells, written in strips of rows
+    for yoff in range(0, cells, 512):
+        rows = min(512, cells - yoff)
+        yy, xx = numpy.mgrid[yoff:yoff + rows, 0:cells]
+        values = numpy.sin(xx / 50.) * numpy.cos(yy / 70.) * 100 + rng.normal(0, 5, (rows, cells))
+        values[rng.random((rows, cells)) < 0.05] = -9999
+        band.WriteArray(values.astype(numpy.float32), 0, yoff)
+    ds.FlushCache()
+    del ds
+
+def makePolygons(path, nPolygons, seed):
+    # random star shaped polygons (some of them overlapping) in WGS84
+    rng = numpy.random.default_rng(seed)
+    driver = ogr.GetDriverByName('GeoJSON')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    data = driver.CreateDataSource(path)
+    layer = data.CreateLayer('polygons', srs, ogr.wkbPolygon)
+    for i in range(nPolygons):
+        cx = rng.uniform(XMIN + 1, XMAX - 1)
+        cy = rng.uniform(YMIN + 1, YMAX - 1)
+        angles = numpy.sort(rng.uniform(0, 2*numpy.pi, 24))
+        radii = rng.uniform(0.3, 1.5, 24)
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for a, r in zip(angles, radii):
+            ring.AddPoint_2D(cx + r*numpy.cos(a), cy + r*numpy.sin(a))
+        ring.CloseRings()
+        poly = ogr.Geometry(ogr.wkbPolygon)
+        poly.AddGeometry(ring)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(poly)
+        layer.CreateFeature(feature)
+        feature = None
+    data = None
+
+def makeOccurrences(nPoints, seed, nSpecies = 20):
+    # clustered occurrences of a few species, with duplicates as in real data sets
+    rng = numpy.random.default_rng(seed)
+    centres = rng.uniform([XMIN + 2, YMIN + 2], [XMAX - 2, YMAX - 2], (nSpecies, 2))
+    species = rng.integers(nSpecies, size=nPoints)
+    xy = centres[species] + rng.normal(0, 1.5, (nPoints, 2))
+    xy[:, 0] = numpy.clip(xy[:, 0], XMIN, XMAX - 1e-9)
+    xy[:, 1] = numpy.clip(xy[:, 1], YMIN, YMAX - 1e-9)
+    xy = numpy.round(xy, 3)
+    return pandas.DataFrame({'species': ['sp{}'.format(s) for s in species], 'x': xy[:, 0], 'y': xy[:, 1]})
+
+def makeFixtures(workdir, size, seed):
+    spec = SIZES[size]
+    fixtures = {'dir': os.path.join(workdir, size), 'spec': spec}
+    os.makedirs(fixtures['dir'], exist_ok=True)
+    fixtures['rasters'] = []
+    for i in range(3):
+        path = os.path.join(fixtures['dir'], 'layer{}.tif'.format(i))
+        makeRaster(path, spec['cells'], seed + i)
+        fixtures['rasters'].append(path)
+    fixtures['polygons'] = os.path.join(fixtures['dir'], 'polygons.json')
+    makePolygons(fixtures['polygons'], spec['polygons'], seed)
+    fixtures['occurrences'] = makeOccurrences(spec['points'], seed)
+    return fixtures
+
+#########################################
+# measurements
+#########################################
+def _maxRss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss*1024
+
+def clearCaches():
+    # every run starts cold: no open datasets and no cached masks or coverage fractions
+    cacheFunc.clearCache()
+    maskFunc.setMaskStore(None)
+    maskFunc.clearMaskCache()
+
+def measure(func, repeat):
+    # best wall time of repeat runs, then one traced run for the peak of python/numpy allocations
+    # (memory allocated inside GDAL is only visible in the process maximum resident set size)
+    times = []
+    for r in range(repeat):
+        clearCaches()
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    clearCaches()
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(times), 'meanSeconds': sum(times)/len(times), 'runs': repeat,
+            'peakTracedBytes': peak, 'maxRssBytes': _maxRss()}
+
+def cases(fixtures):
+    # name -> function of one benchmark case, the outputs go to a scratch directory
+    d = fixtures['dir']
+    spec = fixtures['spec']
+    rasters = fixtures['rasters']
+    occ = fixtures['occurrences']
+    names = [os.path.splitext(os.path.basename(r))[0] for r in rasters]
+    out = os.path.join(d, 'out')
+    os.makedirs(out, exist_ok=True)
+    pixelSize = (XMAX - XMIN) / spec['cells']
+    fishSize = (XMAX - XMIN) / min(spec['cells'] // 4, 500)
+
+    def output(name):
+        path = os.path.join(out, name)
+        if os.path.exists(path):
+            os.remove(path)
+        return path
+
+    def fishNet():
+        path = output('fishnet.gpkg')
+        vectorFunc.createFishNet(path, WGS84, XMIN, YMAX, XMAX, YMIN, cellWidth=fishSize, cellHeight=fishSize)
+
+    def toGeo():
+        groups = [g[['x', 'y']].to_numpy().tolist() for s, g in occ[:20000].groupby('species')]
+        vectorFunc.pointToGeo(4326, groups, os.path.join(out, 'ranges'), {'id': list(range(len(groups)))},
+                              buffer=True, bufferZone=20000)
+
+    return [
+        ('getValuesAtPoint', lambda: rasterFunc.getValuesAtPoint(d, names, occ, 'x', 'y', 'species')),
+        ('getValuesAtPoint.blockRead', lambda: rasterFunc.getValuesAtPoint(d, names, occ, 'x', 'y', 'species', blockRead=True)),
+        ('getValuesAtPoint.threads', lambda: rasterFunc.getValuesAtPoint(d, names, occ, 'x', 'y', 'species', nWorkers=4)),
+        ('getValuesAtPoint.mmap', lambda: rasterFunc.getValuesAtPoint(d, names, occ, 'x', 'y', 'species', mmap=True)),
+        ('getRasterValues', lambda: rasterFunc.getRasterValues(d, names)),
+        ('getRasterValues.mmap', lambda: rasterFunc.getRasterValues(d, names, mmap=True)),
+        ('getRasterValues.threads', lambda: rasterFunc.getRasterValues(d, names, nWorkers=4)),
+        ('getRasterValues.compact', lambda: rasterFunc.getRasterValues(d, names, dtype='native', coords='index')),
+        ('clipRaster', lambda: rasterFunc.clipRaster(rasters[0], output('clip.tif'), fixtures['polygons'])),
+        ('clipRaster.threads', lambda: rasterFunc.clipRaster(rasters[0], output('clip.tif'), fixtures['polygons'], nWorkers=4)),
+        ('zonalStats', lambda: rasterFunc.zonalStats(rasters[0], fixtures['polygons'])),
+        ('filterByCoverage', lambda: rasterFunc.filterByCoverage(fixtures['polygons'], rasters[0], 50)),
+        ('filterByCoverage.processes', lambda: rasterFunc.filterByCoverage(fixtures['polygons'], rasters[0], 50, nProcesses=4)),
+        ('createRaster', lambda: rasterFunc.createRaster(output('created.tif'), XMIN, YMIN, XMAX, YMAX, pixelSize,
+                                                         proj=WGS84, seed=0)),
+        ('createRaster.threads', lambda: rasterFunc.createRaster(output('created.tif'), XMIN, YMIN, XMAX, YMAX, pixelSize,
+                                                                 proj=WGS84, seed=0, nWorkers=4)),
+        ('createFishNet', fishNet),
+        ('disaggregate', lambda: vectorFunc.disaggregate(occ[['x', 'y']], 'x', 'y', 0.08333333, seed=0)),
+        ('pointToGeo', toGeo),
+        ('makeDensityRaster', lambda: bioFunc.makeDensityRaster(occ, fixtures['polygons'], pixelSize*4,
+                                                                output('density.tif'), -9999, species='species')),
+        ('rasterToJSON', lambda: transFunc.rasterToJSON(rasters[0], output('layer0.json'))),
+    ]
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'gdal': gdal.__version__, 'numpy': numpy.__version__, 'pandas': pandas.__version__,
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run(sizes, repeat, seed, only, workdir):
+    results = {'environment': environment(), 'seed': seed, 'results': []}
+    for size in sizes:
+        print('generating {} fixtures'.format(size))
+        fixtures = makeFixtures(workdir, size, seed)
+        for name, func in cases(fixtures):
+            if only and name not in only:
+                continue
+            try:
+                stats = measure(func, repeat)
+            except Exception as e:
+                stats = {'error': '{}: {}'.format(type(e).__name__, e)}
+            stats.update(name=name, size=size)
+            results['results'].append(stats)
+            print('{:<28} {:<7} {}'.format(name, size, '{:.3f} s'.format(stats['seconds']) if 'seconds' in stats else stats['error']))
+    return results
+
+def compare(oldFile, newFile):
+    # ratio of the best times (new / old) of the cases found in both files
+    with open(oldFile) as f:
+        old = {(r['name'], r['size']): r for r in json.load(f)['results']}
+    with open(newFile) as f:
+        new = {(r['name'], r['size']): r for r in json.load(f)['results']}
+    for key in sorted(set(old) & set(new)):
+        if 'seconds' in old[key] and 'seconds' in new[key]:
+            print('{:<28} {:<7} {:9.3f} s {:9.3f} s {:7.2f}x'.format(key[0], key[1], old[key]['seconds'],
+                                                                    new[key]['seconds'], new[key]['seconds']/old[key]['seconds']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chorospy benchmarks')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', nargs='+', help='names of the cases to run')
+    parser.add_argument('--out', default='benchmarkResults.json')
+    parser.add_argument('--workdir', help='directory of the fixtures (a temporary directory by default)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    gdal.UseExceptions()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='chorospyBench')
+    try:
+        results = run(args.sizes, args.repeat, args.seed, args.only, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to {}'.format(args.out))
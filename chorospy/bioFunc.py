@@ -1,14 +1,25 @@
-from osgeo import gdal, ogr, osr
-import os
+from osgeo import ogr
 import pandas
+import numpy
+import logging
+from .rasterFunc import writeRaster
+from .maskFunc import vectorMask
+from .profileFunc import profileStage
 
-def makeDensityRaster(speciesOcc, inVector, pixelSize, outRas, noData):
+logger = logging.getLogger(__name__)
+
+# raster of the number of occurrences ('x', 'y' columns) per cell, within the features of a WGS84 vector file
+# speciesOcc: a DataFrame or an iterator of DataFrames (e.g. pandas.read_csv(..., chunksize = 10**6))
+# species: column with species names, writes one band per species (in sorted order, named after the species)
+# creationOptions, cog: see writeRaster
+# returns the number of occurrences outside the features
+def makeDensityRaster(speciesOcc, inVector, pixelSize, outRas, noData, species = None, creationOptions = None, cog = False):
     srcVector = ogr.Open(inVector)
     srcLayer = srcVector.GetLayer()
     srs = srcLayer.GetSpatialRef()
     # if the layer is not wgs84
     if srs.GetAttrValue("AUTHORITY", 1) != '4326':
-        print('Layer projection should be WGS84!')
+        logger.warning('Layer projection should be WGS84!')
         return
 
     xMin, xMax, yMin, yMax = srcLayer.GetExtent()
@@ -16,32 +27,74 @@ def makeDensityRaster(speciesOcc, inVector, pixelSize, outRas, noData):
     # Create the destination data source
     xRes = int((xMax - xMin) / pixelSize)
     yRes = int((yMax - yMin) / pixelSize)
-    targetRas = gdal.GetDriverByName('GTiff').Create(outRas, xRes, yRes, 1, 6) # 6 == float
-    targetRas.SetGeoTransform((xMin, pixelSize, 0, yMax, 0, -pixelSize))
-    band = targetRas.GetRasterBand(1)
-    band.SetNoDataValue(noData)
-
-    # Rasterize clips the raster band
-    gdal.RasterizeLayer(targetRas, [1], srcLayer, None, None, [0], ['ALL_TOUCHED=TRUE'])
-    #os.remove(outRas)
-    g = band.ReadAsArray()
-
-    for point in speciesOcc.iterrows():
-        xi = int((point[1]['x'] - xMin) / pixelSize)
-        yi = int((point[1]['y'] - yMax) / -pixelSize)
-
-        try:
-            if g[yi,xi] != noData:
-                g[yi,xi] += 1
+    geoTransform = (xMin, pixelSize, 0, yMax, 0, -pixelSize)
+
+    # Rasterize the features to find the cells inside them (cached, see vectorMask)
+    mask = vectorMask(inVector, geoTransform, xRes, yRes, srs.ExportToWkt())
+
+    if isinstance(speciesOcc, pandas.DataFrame):
+        speciesOcc = [speciesOcc]
+
+    # one counter row per species (in order of appearance), grown as new species appear
+    ncell = xRes*yRes
+    codes = {}
+    counts = numpy.zeros((0, ncell), dtype=numpy.uint32)
+    outOfBounds = 0
+    missing = 0
+    for chunk in speciesOcc:
+        with profileStage('makeDensityRaster', 'compute') as st:
+            st.count(pixels = len(chunk))
+            x = chunk['x'].to_numpy(dtype=numpy.float64)
+            y = chunk['y'].to_numpy(dtype=numpy.float64)
+            xi = numpy.floor((x - xMin) / pixelSize)
+            yi = numpy.floor((y - yMax) / -pixelSize)
+            inside = (xi >= 0) & (xi < xRes) & (yi >= 0) & (yi < yRes)
+            cell = (yi[inside]*xRes + xi[inside]).astype(numpy.int64)
+            # cells outside the features are out of bounds too
+            keep = mask.ravel()[cell]
+            outOfBounds += len(x) - int(keep.sum())
+            cell = cell[keep]
+
+            if species:
+                # species codes of the chunk mapped to the counter rows
+                local, names = pandas.factorize(chunk[species].to_numpy()[inside][keep])
+                rows = numpy.array([codes.setdefault(name, len(codes)) for name in names], dtype=numpy.int64)
+                known = local >= 0
+                missing += len(local) - int(known.sum())
+                code, cell = rows[local[known]], cell[known]
             else:
-                print('point ({}, {}) out of bounds'.format(point[1]['x'], point[1]['y']))
-        except:
-            print('point ({}, {}) out of bounds'.format(point[1]['x'], point[1]['y']))
-            pass
+                codes.setdefault(None, 0)
+                code = numpy.zeros(len(cell), dtype=numpy.int64)
+
+            if len(codes) > counts.shape[0]:
+                grown = numpy.zeros((max(len(codes), 2*counts.shape[0]), ncell), dtype=numpy.uint32)
+                grown[:counts.shape[0]] = counts
+                counts = grown
+            # all species in one pass, without grid sized temporaries
+            keys, n = numpy.unique(code*ncell + cell, return_counts=True)
+            counts.reshape(-1)[keys] += n.astype(numpy.uint32)
+
+    if not codes:
+        codes[None] = 0
+        counts = numpy.zeros((1, ncell), dtype=numpy.uint32)
+    # drop the unused rows left by the doubling
+    counts.resize((len(codes), ncell), refcheck=False)
+    bandNames = sorted(codes, key=str)
+    order = [codes[name] for name in bandNames]
 
+    # all bands written by blocks of rows, so only one block is held as float32 next to the counts
+    def rowBlocks():
+        nrows = max(1, 2**22 // (len(order)*xRes or 1))
+        for yoff in range(0, yRes, nrows):
+            n = min(nrows, yRes - yoff)
+            block = counts[order, yoff*xRes:(yoff + n)*xRes].reshape(len(order), n, xRes).astype(numpy.float32)
+            block[:, ~mask[yoff:yoff + n]] = noData
+            yield yoff, block
+    writeRaster(outRas, rowBlocks(), geoTransform, srs.ExportToWkt(), noData, 'float32', creationOptions, cog,
+                shape = (len(order), yRes, xRes), bandNames = bandNames if species else None)
 
-    band.WriteArray(g)
-    targetRasSRS = osr.SpatialReference()
-    targetRasSRS.ImportFromWkt(srs.ExportToWkt())
-    targetRas.SetProjection(targetRasSRS.ExportToWkt())
-    band.FlushCache()
\ No newline at end of file
+    if missing:
+        logger.warning('{} points without species skipped'.format(missing))
+    if outOfBounds:
+        logger.warning('{} points out of bounds'.format(outOfBounds))
+    return outOfBounds
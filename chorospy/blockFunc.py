@@ -0,0 +1,130 @@
+import numpy
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .cacheFunc import openRaster, mapRaster
+from .profileFunc import profileStage
+
+# block engine: iterate a raster grid in blocks aligned to its native blocks (tiles or strips),
+# map a function over the blocks in a thread or process pool and collect the results in block order
+
+#one block of a raster grid
+#xoff, yoff, xsize, ysize: the block in raster pixels; outXoff, outYoff: its offset in the iterated window
+#readWindow: the window read for the block, i.e. the block and its halo (it may extend outside the raster)
+#core: slices of the block in the data read for it; geoTransform: of the block, if the grid's one was given
+class Block:
+    __slots__ = ('index', 'xoff', 'yoff', 'xsize', 'ysize', 'outXoff', 'outYoff', 'readWindow', 'core', 'geoTransform')
+
+    def __repr__(self):
+        return 'Block({}, {}, {}, {})'.format(self.xoff, self.yoff, self.xsize, self.ysize)
+
+#blocks of a grid of xSize x ySize pixels in row major order
+#blockSize: (columns, rows) of the native blocks, e.g. band.GetBlockSize(); use (xSize, n) for strips of n rows
+#halo: pixels around each block that are read with it (filled with the fill value of mapBlocks outside the raster)
+#window: (xoff, yoff, xsize, ysize) part of the grid to iterate, the blocks stay aligned to the native blocks
+def rasterBlocks(xSize, ySize, blockSize = (256, 256), halo = 0, window = None, geoTransform = None):
+    bx, by = blockSize
+    wx, wy, wxs, wys = window if window is not None else (0, 0, xSize, ySize)
+    xEdges = [wx] + list(range((wx // bx + 1)*bx, wx + wxs, bx)) + [wx + wxs]
+    yEdges = [wy] + list(range((wy // by + 1)*by, wy + wys, by)) + [wy + wys]
+    index = 0
+    for y0, y1 in zip(yEdges[:-1], yEdges[1:]):
+        for x0, x1 in zip(xEdges[:-1], xEdges[1:]):
+            block = Block()
+            block.index = index
+            block.xoff, block.yoff, block.xsize, block.ysize = x0, y0, x1 - x0, y1 - y0
+            block.outXoff, block.outYoff = x0 - wx, y0 - wy
+            block.readWindow = (x0 - halo, y0 - halo, x1 - x0 + 2*halo, y1 - y0 + 2*halo)
+            block.core = (slice(halo, halo + y1 - y0), slice(halo, halo + x1 - x0))
+            block.geoTransform = None
+            if geoTransform is not None:
+                gt = geoTransform
+                block.geoTransform = (gt[0] + x0*gt[1] + y0*gt[2], gt[1], gt[2], gt[3] + x0*gt[4] + y0*gt[5], gt[4], gt[5])
+            index += 1
+            yield block
+
+#map func(data, block, *args) over blocks and yield (block, result) in block order
+#rasters: raster files (band 1 of each) read for every block as data, a 3-D (raster, row, column) array of the
+#read window of the block; None for functions that only compute (data is then None)
+#nWorkers: size of the pool (None or 1 runs in the calling thread); threads suit GDAL and numpy work, which
+#release the GIL; useProcesses for pure python work, func and args must then be picklable (module level functions)
+#at most maxInFlight blocks (2*nWorkers by default) are processed or waiting to be consumed at any time
+#fill: value of the cells of the read window outside the raster; mmap: read uncompressed GeoTIFFs through memory maps
+def mapBlocks(func, blocks, rasters = None, nWorkers = None, useProcesses = False, args = (), fill = 0, mmap = False, maxInFlight = None):
+    return _orderedMap(partial(_runBlock, func, rasters, args, fill, mmap), blocks, nWorkers, useProcesses, maxInFlight)
+
+#map func(dataset, path, *args) over raster files and yield (path, result) in list order
+#nWorkers threads open and read the rasters concurrently, every worker through its own GDAL dataset; GDAL releases
+#the GIL while reading, so the latency of slow (e.g. network) storage overlaps
+#at most maxInFlight rasters (2*nWorkers by default) are read or waiting to be consumed, which caps the memory of the results
+def mapRasters(func, rasters, nWorkers = None, args = (), maxInFlight = None):
+    return _orderedMap(partial(_runRaster, func, args), rasters, nWorkers, False, maxInFlight)
+
+# yield (item, run(item)) in item order, in a pool of nWorkers with at most maxInFlight pending items
+def _orderedMap(run, items, nWorkers, useProcesses = False, maxInFlight = None):
+    if not nWorkers or nWorkers == 1:
+        for item in items:
+            yield item, run(item)
+        return
+
+    maxInFlight = maxInFlight or 2*nWorkers
+    pool = (ProcessPoolExecutor if useProcesses else ThreadPoolExecutor)(nWorkers)
+    with pool:
+        pending = deque()
+        for item in items:
+            # GDAL datasets can not be shared between threads, every worker reads through its own (see openRaster)
+            pending.append((item, pool.submit(run, item)))
+            if len(pending) >= maxInFlight:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+#assemble the (block, array) results of mapBlocks in one array of the iterated window (xSize x ySize)
+#the arrays are the blocks without halo, 2-D or with leading dimensions (e.g. bands)
+def mergeBlocks(results, xSize, ySize, fill = 0):
+    array = None
+    for block, values in results:
+        if array is None:
+            array = numpy.full(values.shape[:-2] + (ySize, xSize), fill, dtype=values.dtype)
+        array[..., block.outYoff:block.outYoff + block.ysize, block.outXoff:block.outXoff + block.xsize] = values
+    return array
+
+def _runBlock(func, rasters, args, fill, mmap, block):
+    data = None
+    if rasters is not None:
+        with profileStage('mapBlocks', 'read') as st:
+            data = _readBlock(rasters, block, fill, mmap)
+            st.count(data)
+    with profileStage('mapBlocks', 'compute'):
+        return func(data, block, *args)
+
+def _runRaster(func, args, path):
+    with profileStage('mapRasters', 'open'):
+        dataset = openRaster(path)
+    return func(dataset, path, *args)
+
+# read window of a block for all rasters, cells outside a raster get the fill value
+def _readBlock(rasters, block, fill, mmap):
+    rx, ry, rxs, rys = block.readWindow
+    layers = []
+    for path in rasters:
+        rasterMap = mapRaster(path) if mmap else None
+        if rasterMap is not None:
+            read, xSize, ySize = rasterMap.read, rasterMap.xSize, rasterMap.ySize
+        else:
+            dataset = openRaster(path)
+            read, xSize, ySize = dataset.GetRasterBand(1).ReadAsArray, dataset.RasterXSize, dataset.RasterYSize
+
+        x0, y0, x1, y1 = max(rx, 0), max(ry, 0), min(rx + rxs, xSize), min(ry + rys, ySize)
+        if (x0, y0, x1, y1) == (rx, ry, rx + rxs, ry + rys):
+            layers.append(read(rx, ry, rxs, rys))
+        elif x1 <= x0 or y1 <= y0:
+            layers.append(numpy.full((rys, rxs), fill))
+        else:
+            part = read(x0, y0, x1 - x0, y1 - y0)
+            data = numpy.full((rys, rxs), fill, dtype=numpy.result_type(part, fill))
+            data[y0 - ry:y1 - ry, x0 - rx:x1 - rx] = part
+            layers.append(data)
+    return layers[0][numpy.newaxis] if len(layers) == 1 else numpy.stack(layers)
@@ -0,0 +1,273 @@
+from osgeo import gdal
+from collections import OrderedDict
+import numpy
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# size bounded (least recently used) cache of read-only GDAL datasets and their parsed metadata
+# entries are keyed by path plus modification time and size, so a rewritten file is opened again
+# the metadata and memory maps are shared, the datasets are cached per thread (GDAL datasets are not thread-safe),
+# so openRaster can be used from several threads at once; never write to a dataset returned by openRaster
+maxCacheSize = 64
+
+_cache = OrderedDict()
+_lock = threading.RLock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_local = threading.local()
+
+def _key(path):
+    # VSIStatL also works for the /vsimem/ and other virtual file systems
+    stat = gdal.VSIStatL(path)
+    if stat is None:
+        return None
+    if '://' not in path and not path.startswith('/vsi'):
+        path = os.path.abspath(path)
+    return (path, stat.mtime, stat.size)
+
+def _readInfo(dataset):
+    band = dataset.GetRasterBand(1)
+    info = {'geoTransform': dataset.GetGeoTransform(),
+            'projection': dataset.GetProjection(),
+            'xSize': dataset.RasterXSize,
+            'ySize': dataset.RasterYSize,
+            'bandCount': dataset.RasterCount,
+            'nodata': band.GetNoDataValue() if band is not None else None,
+            'dataType': band.DataType if band is not None else None,
+            'blockSize': tuple(band.GetBlockSize()) if band is not None else None}
+    return info
+
+# datasets of the current thread (or process, which may have inherited the handles of its parent): key -> (entry, dataset)
+def _threadDatasets():
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.datasets = OrderedDict()
+    return _local.datasets
+
+# (dataset, info, maps) of a raster; without needDataset the dataset may be None when the metadata is cached
+def _lookup(path, needDataset = True):
+    key = _key(path)
+    if key is None:
+        # not a file GDAL can stat, open it without caching
+        dataset = gdal.Open(path)
+        return dataset, _readInfo(dataset) if dataset is not None else None
+    datasets = _threadDatasets()
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+            if not needDataset:
+                _stats['hits'] += 1
+                return (None,) + entry
+            cached = datasets.get(key)
+            # a handle of an entry that was cleared or evicted in the meantime is not used
+            if cached is not None and cached[0] is entry:
+                _stats['hits'] += 1
+                datasets.move_to_end(key)
+                return (cached[1],) + entry
+        _stats['misses'] += 1
+    # opened outside the lock, so several rasters can be opened concurrently (see prefetchRasters)
+    dataset = gdal.Open(path)
+    if dataset is None:
+        return None, None
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            # the memory maps of the bands are added on first use
+            entry = (_readInfo(dataset), {})
+            # drop older versions of the same file
+            for old in [k for k in _cache if k[0] == key[0]]:
+                del _cache[old]
+            _cache[key] = entry
+            while len(_cache) > maxCacheSize:
+                _cache.popitem(last=False)
+                _stats['evictions'] += 1
+    for old in [k for k in datasets if k[0] == key[0]]:
+        del datasets[old]
+    datasets[key] = (entry, dataset)
+    while len(datasets) > maxCacheSize:
+        datasets.popitem(last=False)
+    return (dataset,) + entry
+
+# cached read-only dataset of a raster file for the current thread (None if it can not be opened)
+def openRaster(path):
+    return _lookup(path)[0]
+
+# cached metadata of a raster file: geoTransform, projection, xSize, ySize, bandCount,
+# and nodata, dataType (GDAL type code) and blockSize of the first band
+def rasterInfo(path):
+    info = _lookup(path, False)[1]
+    return dict(info) if info is not None else None
+
+# read the metadata of raster files into the cache with nWorkers threads, which overlaps the latency of slow
+# (e.g. network) storage; returns the metadata of each file in list order (None for files that can not be opened)
+def prefetchRasters(paths, nWorkers = 4):
+    paths = list(paths)
+    if not nWorkers or nWorkers == 1 or len(paths) < 2:
+        return [rasterInfo(path) for path in paths]
+    with ThreadPoolExecutor(min(nWorkers, len(paths))) as pool:
+        return list(pool.map(rasterInfo, paths))
+
+# read-only memory map of one band of an uncompressed GeoTIFF (None for other rasters, which are read through GDAL)
+# the pixels are paged in from the file when they are touched, and the page cache is shared between processes
+def mapRaster(path, band = 1):
+    entry = _lookup(path, False)
+    if len(entry) < 3:
+        # not cached (or not a local file)
+        return None
+    maps = entry[2]
+    if band not in maps:
+        # the dataset is only needed to map the band
+        entry = _lookup(path)
+    with _lock:
+        if band not in maps:
+            try:
+                maps[band] = _mapBand(path, entry[0], band)
+            except (OSError, ValueError):
+                maps[band] = None
+        return maps[band]
+
+# numpy types of the GDAL data types that can be mapped
+_MAP_TYPES = {1: 'u1', 2: 'u2', 3: 'i2', 4: 'u4', 5: 'i4', 6: 'f4', 7: 'f8'}
+
+def _mapBand(path, dataset, b):
+    if dataset.GetDriver().ShortName != 'GTiff' or not os.path.isfile(path):
+        return None
+    band = dataset.GetRasterBand(b)
+    if band is None or band.DataType not in _MAP_TYPES:
+        return None
+    structure = dataset.GetMetadata('IMAGE_STRUCTURE') or {}
+    if structure.get('COMPRESSION', 'NONE') != 'NONE' or band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE'):
+        return None
+    with open(path, 'rb') as fp:
+        endian = {b'II': '<', b'MM': '>'}.get(fp.read(2))
+    if endian is None:
+        return None
+
+    # file offsets of the blocks (strips or tiles) of the band, sparse (unwritten) blocks can not be mapped
+    bx, by = band.GetBlockSize()
+    offsets = numpy.zeros((int(math.ceil(dataset.RasterYSize / by)), int(math.ceil(dataset.RasterXSize / bx))), dtype=numpy.int64)
+    for y in range(offsets.shape[0]):
+        for x in range(offsets.shape[1]):
+            offset = band.GetMetadataItem('BLOCK_OFFSET_{}_{}'.format(x, y), 'TIFF')
+            if not offset or int(offset) == 0:
+                return None
+            offsets[y, x] = int(offset)
+
+    dtype = numpy.dtype(endian + _MAP_TYPES[band.DataType])
+    if dataset.RasterCount > 1 and structure.get('INTERLEAVE', 'PIXEL') == 'PIXEL':
+        # the bands share the blocks, one pixel after the other
+        pixelStride, bandOffset = dtype.itemsize*dataset.RasterCount, dtype.itemsize*(b - 1)
+    else:
+        pixelStride, bandOffset = dtype.itemsize, 0
+    return _RasterMap(path, dtype, (bx, by), dataset.RasterXSize, dataset.RasterYSize, offsets, pixelStride, bandOffset)
+
+#pixels of one band, mapped from the blocks of the file
+#read() and sample() follow GDAL's ReadAsArray window and pixel order; when the blocks of the band are stored
+#one after the other, strips give a zero-copy 2-D view of the band (view) and read() returns slices of it
+class _RasterMap:
+    def __init__(self, path, dtype, blockSize, xSize, ySize, offsets, pixelStride, bandOffset):
+        self.path = path
+        self.dtype = dtype
+        self.blockSize = blockSize
+        self.xSize, self.ySize = xSize, ySize
+        self.offsets = offsets
+        self.pixelStride = pixelStride
+        self.bandOffset = bandOffset
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+
+        bx, by = blockSize
+        blockBytes = bx*by*pixelStride
+        first = int(offsets[0, 0]) + bandOffset
+        contiguous = numpy.array_equal(offsets.ravel(), offsets[0, 0] + numpy.arange(offsets.size)*blockBytes)
+        self.view = None
+        if contiguous and offsets.shape[1] == 1:
+            self.view = numpy.ndarray((ySize, xSize), dtype, self.data, first, (bx*pixelStride, pixelStride))
+        elif contiguous:
+            # (block row, block column, row, column) view of the tiles
+            self.tiles = numpy.ndarray(offsets.shape + (by, bx), dtype, self.data, first,
+                                       (offsets.shape[1]*blockBytes, blockBytes, bx*pixelStride, pixelStride))
+        self.contiguous = contiguous
+
+    # values at the given pixel indices (rows, cols inside the band), only the touched pages are read
+    def sample(self, rows, cols):
+        if self.view is not None:
+            return self.view[rows, cols]
+        bx, by = self.blockSize
+        if self.contiguous:
+            return self.tiles[rows // by, cols // bx, rows % by, cols % bx]
+        pos = self.offsets[rows // by, cols // bx] + ((rows % by)*bx + cols % bx)*self.pixelStride + self.bandOffset
+        return self.data[pos.ravel()[:, numpy.newaxis] + numpy.arange(self.dtype.itemsize)].view(self.dtype).reshape(pos.shape)
+
+    # window of the band, a read-only view for contiguous strips and a copy otherwise
+    # the copy is assembled from the touched blocks, without per pixel index arrays
+    def read(self, xoff = 0, yoff = 0, xsize = None, ysize = None):
+        xsize = self.xSize - xoff if xsize is None else xsize
+        ysize = self.ySize - yoff if ysize is None else ysize
+        if self.view is not None:
+            return self.view[yoff:yoff + ysize, xoff:xoff + xsize]
+        if ysize <= 0 or xsize <= 0:
+            return numpy.empty((max(ysize, 0), max(xsize, 0)), self.dtype)
+        bx, by = self.blockSize
+        br0, bc0 = yoff // by, xoff // bx
+        br1, bc1 = (yoff + ysize - 1) // by, (xoff + xsize - 1) // bx
+        if self.contiguous:
+            # the touched tiles in one copy, cropped to the window
+            tiles = self.tiles[br0:br1 + 1, bc0:bc1 + 1]
+            nr, nc = tiles.shape[:2]
+            window = tiles.transpose(0, 2, 1, 3).reshape(nr*by, nc*bx)
+            return window[yoff - br0*by:yoff - br0*by + ysize, xoff - bc0*bx:xoff - bc0*bx + xsize]
+        out = numpy.empty((ysize, xsize), self.dtype)
+        for br in range(br0, br1 + 1):
+            for bc in range(bc0, bc1 + 1):
+                block = self._block(br, bc)
+                # the part of the block inside the window
+                r0, r1 = max(yoff, br*by), min(yoff + ysize, br*by + block.shape[0])
+                c0, c1 = max(xoff, bc*bx), min(xoff + xsize, bc*bx + block.shape[1])
+                out[r0 - yoff:r1 - yoff, c0 - xoff:c1 - xoff] = block[r0 - br*by:r1 - br*by, c0 - bc*bx:c1 - bc*bx]
+        return out
+
+    # read-only view of one block (strip or tile), limited to the pixels inside the band
+    def _block(self, br, bc):
+        bx, by = self.blockSize
+        shape = (min(by, self.ySize - br*by), min(bx, self.xSize - bc*bx))
+        return numpy.ndarray(shape, self.dtype, self.data, int(self.offsets[br, bc]) + self.bandOffset,
+                             (bx*self.pixelStride, self.pixelStride))
+
+# drop one file (all its versions) or, without a path, every entry from the cache
+def clearCache(path = None):
+    datasets = _threadDatasets()
+    with _lock:
+        if path is None:
+            _cache.clear()
+            datasets.clear()
+            return
+        key = _key(path)
+        name = key[0] if key is not None else os.path.abspath(path)
+        for old in [k for k in _cache if k[0] in (name, path)]:
+            del _cache[old]
+        # the datasets of the other threads are replaced on their next lookup of the file
+        for old in [k for k in datasets if k[0] in (name, path)]:
+            del datasets[old]
+
+# change the maximum number of cached datasets, evicting the least recently used ones
+def setCacheSize(size):
+    global maxCacheSize
+    with _lock:
+        maxCacheSize = size
+        while len(_cache) > maxCacheSize:
+            _cache.popitem(last=False)
+            _stats['evictions'] += 1
+    datasets = _threadDatasets()
+    while len(datasets) > maxCacheSize:
+        datasets.popitem(last=False)
+
+# hit, miss and eviction counters and the current number of cached datasets
+def cacheStats(reset = False):
+    with _lock:
+        stats = dict(_stats, size=len(_cache), maxSize=maxCacheSize)
+        if reset:
+            for k in _stats:
+                _stats[k] = 0
+    return stats
@@ -0,0 +1,134 @@
+from osgeo import gdal, ogr
+from collections import OrderedDict
+import numpy
+import hashlib
+import os
+import threading
+from .cacheFunc import _key
+from .profileFunc import profileStage
+
+# size bounded (least recently used, in bytes) cache of arrays computed from a vector file on a raster grid,
+# such as the cells touched by its features; entries are keyed by the vector path plus modification time and size,
+# the grid (geotransform, size, projection) and the rasterization options, so an edited vector is rasterized again
+# with a store directory the arrays are also written there (compressed) and found again by later sessions
+# cached arrays are shared and read-only
+maxMaskBytes = 2**28
+maskStore = None
+
+_masks = OrderedDict()
+_lock = threading.RLock()
+_stats = {'hits': 0, 'storeHits': 0, 'misses': 0, 'evictions': 0}
+_bytes = 0
+
+# cells of a grid touched by the features of a vector file, as a read-only boolean array
+# without a projection the features are taken to be in the coordinates of the grid
+# options: gdal.RasterizeLayer options, e.g. ['ALL_TOUCHED=FALSE'] for the cells whose center is inside a feature
+def vectorMask(vector, geoTransform, xSize, ySize, projection = None, options = ['ALL_TOUCHED=TRUE']):
+    def compute():
+        srcVector = ogr.Open(vector)
+        return _rasterizeMask(srcVector.GetLayer(), geoTransform, xSize, ySize, projection, options)
+    return cachedArray('mask', vector, (tuple(geoTransform), xSize, ySize, projection or '', tuple(options)), compute)
+
+# array computed by compute() from a vector file, cached under the kind of array and the grid key (any hashable)
+def cachedArray(kind, vector, key, compute):
+    global _bytes
+    vectorKey = _key(vector)
+    if vectorKey is None:
+        # not a file GDAL can stat, computed without caching
+        return compute()
+    key = (kind, vectorKey) + tuple(key)
+    with _lock:
+        array = _masks.get(key)
+        if array is not None:
+            _stats['hits'] += 1
+            _masks.move_to_end(key)
+            return array
+        store = maskStore
+
+    path = os.path.join(store, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz') if store else None
+    if path and os.path.exists(path):
+        with profileStage('vectorMask', 'read') as st:
+            with numpy.load(path) as npz:
+                array = npz['array']
+            st.count(array)
+        hit = 'storeHits'
+    else:
+        with profileStage('vectorMask', 'compute') as st:
+            array = compute()
+            st.count(array)
+        if path:
+            with profileStage('vectorMask', 'write'):
+                _storeArray(path, array)
+        hit = 'misses'
+    array.flags.writeable = False
+
+    with _lock:
+        _stats[hit] += 1
+        if key not in _masks:
+            _masks[key] = array
+            _bytes += array.nbytes
+            _evict(maxMaskBytes)
+        return _masks.get(key, array)
+
+# drop the cached arrays of one vector file, or all of them without an argument (the store is kept)
+def clearMaskCache(vector = None):
+    global _bytes
+    with _lock:
+        if vector is None:
+            _masks.clear()
+            _bytes = 0
+            return
+        vectorKey = _key(vector)
+        name = vectorKey[0] if vectorKey is not None else os.path.abspath(vector)
+        for old in [k for k in _masks if k[1][0] == name]:
+            _bytes -= _masks.pop(old).nbytes
+
+# change the maximum size (in bytes) of the cached arrays, evicting the least recently used ones
+def setMaskCacheSize(nbytes):
+    global maxMaskBytes
+    with _lock:
+        maxMaskBytes = nbytes
+        _evict(maxMaskBytes)
+
+# directory of the compressed on-disk store (created if needed), None to only cache in memory
+def setMaskStore(directory):
+    global maskStore
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    with _lock:
+        maskStore = directory
+
+# hit (memory and store), miss and eviction counters, and the current number and size of cached arrays
+def maskCacheStats(reset = False):
+    with _lock:
+        stats = dict(_stats, size=len(_masks), bytes=_bytes, maxBytes=maxMaskBytes, store=maskStore)
+        if reset:
+            for k in _stats:
+                _stats[k] = 0
+    return stats
+
+def _evict(nbytes):
+    global _bytes
+    # an array larger than the cache is not kept
+    while _masks and _bytes > nbytes:
+        _bytes -= _masks.popitem(last=False)[1].nbytes
+        _stats['evictions'] += 1
+
+# written to a temporary name first, so concurrent readers never see a partial file
+def _storeArray(path, array):
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as fp:
+        numpy.savez_compressed(fp, array=array)
+    os.replace(tmp, path)
+
+#cells of a grid touched by the features of a layer, as a boolean array
+#without a projection the features are taken to be in the coordinates of the grid
+def _rasterizeMask(lyr, geoTransform, xSize, ySize, projection, options = ['ALL_TOUCHED=TRUE']):
+    maskRas = gdal.GetDriverByName('MEM').Create('', xSize, ySize, 1, gdal.GDT_Byte)
+    maskRas.SetGeoTransform(geoTransform)
+    if projection:
+        maskRas.SetProjection(projection)
+    gdal.RasterizeLayer(maskRas, [1], lyr, None, None, [1], options)
+    mask = maskRas.GetRasterBand(1).ReadAsArray().astype(bool)
+    del maskRas
+    return mask
@@ -0,0 +1,142 @@
+import threading
+import time
+import pandas
+
+# timing instrumentation of the stages (open, read, compute, write) of chorospy functions
+# every stage records its wall time and, where it applies, the bytes and pixels (or features) it handled
+# records are aggregated per (function, stage) and passed to the registered hooks
+# profiling is off by default; the functions then get a shared no-op stage, so it costs nothing
+_enabled = False
+_hooks = []
+_records = {}
+_lock = threading.Lock()
+
+class _Stage:
+    __slots__ = ('function', 'stage', 'bytes', 'pixels', 'start')
+
+    def __init__(self, function, stage):
+        self.function = function
+        self.stage = stage
+        self.bytes = 0
+        self.pixels = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.function, self.stage, time.perf_counter() - self.start, self.bytes, self.pixels)
+
+    # add an array (its size and number of bytes), or explicit pixel/feature and byte counts
+    def count(self, array = None, pixels = 0, nbytes = 0):
+        if array is not None:
+            pixels += array.size
+            nbytes += array.nbytes
+        self.pixels += pixels
+        self.bytes += nbytes
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def count(self, array = None, pixels = 0, nbytes = 0):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+def _record(function, stage, seconds, nbytes, pixels):
+    with _lock:
+        rec = _records.get((function, stage))
+        if rec is None:
+            rec = _records[(function, stage)] = {'function': function, 'stage': stage, 'calls': 0,
+                                                 'seconds': 0., 'bytes': 0, 'pixels': 0}
+        rec['calls'] += 1
+        rec['seconds'] += seconds
+        rec['bytes'] += nbytes
+        rec['pixels'] += pixels
+        hooks = list(_hooks)
+    event = {'function': function, 'stage': stage, 'seconds': seconds, 'bytes': nbytes, 'pixels': pixels}
+    for hook in hooks:
+        hook(event)
+
+# context manager timing one stage of a function
+# with profileStage('myAnalysis', 'compute') as st: ...; st.count(array)
+def profileStage(function, stage):
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(function, stage)
+
+# start recording; hook: optional callable that gets a dict (function, stage, seconds, bytes, pixels) per stage
+def enableProfiling(hook = None):
+    global _enabled
+    if hook is not None:
+        addProfileHook(hook)
+    _enabled = True
+
+def disableProfiling():
+    global _enabled
+    _enabled = False
+
+def addProfileHook(hook):
+    with _lock:
+        if hook not in _hooks:
+            _hooks.append(hook)
+
+def removeProfileHook(hook):
+    with _lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+# aggregated records as a data frame (function, stage, calls, seconds, bytes, pixels)
+def profileReport(reset = False):
+    with _lock:
+        report = pandas.DataFrame([dict(r) for r in _records.values()],
+                                  columns=['function', 'stage', 'calls', 'seconds', 'bytes', 'pixels'])
+        if reset:
+            _records.clear()
+    return report
+
+# record the stages of the enclosed calls only
+# with chorospy.profiling() as report: ...; report() returns the records of the block
+class profiling:
+    def __init__(self, hook = None):
+        self.hook = hook
+
+    def __enter__(self):
+        self.wasEnabled = _enabled
+        self.records = {}
+        self.lock = threading.Lock()
+        addProfileHook(self._collect)
+        if self.hook is not None:
+            addProfileHook(self.hook)
+        enableProfiling()
+        return self.report
+
+    def __exit__(self, *exc):
+        if not self.wasEnabled:
+            disableProfiling()
+        removeProfileHook(self._collect)
+        if self.hook is not None:
+            removeProfileHook(self.hook)
+
+    def _collect(self, event):
+        key = (event['function'], event['stage'])
+        with self.lock:
+            rec = self.records.get(key)
+            if rec is None:
+                rec = self.records[key] = dict(event, calls=0, seconds=0., bytes=0, pixels=0)
+            rec['calls'] += 1
+            rec['seconds'] += event['seconds']
+            rec['bytes'] += event['bytes']
+            rec['pixels'] += event['pixels']
+
+    def report(self):
+        with self.lock:
+            records = [dict(r) for r in self.records.values()]
+        return pandas.DataFrame(records,
+                                columns=['function', 'stage', 'calls', 'seconds', 'bytes', 'pixels'])
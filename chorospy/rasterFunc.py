@@ -1,362 +1,953 @@
-from osgeo import osr,ogr,gdal
+from osgeo import osr,ogr,gdal,gdal_array
 import pandas
 import numpy
 import os
 import math
-
-def getValuesAtPoint(indir, rasterfileList, pos, lon='x', lat='y', sp = ''):
+import logging
+import tempfile
+import uuid
+from .cacheFunc import openRaster, rasterInfo, clearCache, mapRaster, prefetchRasters
+from .transFunc import reprojectPoints
+from .profileFunc import profileStage
+from .blockFunc import rasterBlocks, mapBlocks, mapRasters, mergeBlocks
+from .maskFunc import vectorMask, cachedArray, _rasterizeMask
+from . import maskFunc
+
+logger = logging.getLogger(__name__)
+
+#convert map coordinates to pixel indices (row, column) of a north-up raster
+#points left/above the origin get negative indices, so they can be masked later
+def _coordsToPixels(gt, xs, ys):
+    cols = numpy.floor((numpy.asarray(xs, dtype=numpy.float64) - gt[0]) / gt[1]).astype(numpy.int64)
+    rows = numpy.floor((numpy.asarray(ys, dtype=numpy.float64) - gt[3]) / gt[5]).astype(numpy.int64)
+    return rows, cols
+
+#format cell center coordinates the way the extraction functions always did
+def _formatCoords(values):
+    return ['{:.6f}'.format(v) for v in values]
+
+#the cell columns of the extraction tables for the given pixel rows and columns
+#coords: 'string' (Xc, Yc cell centers as '{:.6f}' strings), 'float' (Xc, Yc as float64) or 'index' (col, row as int64)
+def _cellColumns(gt, rows, cols, coords):
+    if coords == 'index':
+        return {'col': numpy.asarray(cols, dtype=numpy.int64), 'row': numpy.asarray(rows, dtype=numpy.int64)}
+    Xc = gt[0] + cols*gt[1] + gt[1]/2 #the cell center x
+    Yc = gt[3] + rows*gt[5] + gt[5]/2 #the cell center y
+    if coords == 'float':
+        return {'Xc': Xc, 'Yc': Yc}
+    if coords == 'string':
+        return {'Xc': _formatCoords(Xc), 'Yc': _formatCoords(Yc)}
+    raise ValueError("coords must be 'string', 'float' or 'index'")
+
+#column of the values of one layer with the nodata cells masked
+#dtype None: float64 with nan (the default of the extraction functions); 'native': the data type of the raster;
+#or any numpy type (e.g. 'float32', 'int16'); nodata is nan for float types and a missing value
+#of a nullable pandas integer column (e.g. Int16) for integer types
+#the nodata cells are filled before the cast; values (with data) that the integer type can not hold raise a ValueError
+def _valueColumn(values, noDat, dtype = None):
+    target = numpy.dtype(numpy.float64 if dtype is None else values.dtype if dtype == 'native' else dtype)
+    noDat = numpy.asarray(noDat, dtype=bool)
+    if target.kind in 'fc':
+        if values.dtype.kind not in 'fc':
+            values = values.astype(target)
+        return numpy.where(noDat, numpy.nan, values).astype(target)
+    values = numpy.where(noDat, 0, values)
+    if values.dtype != target and values.size:
+        info = numpy.iinfo(target)
+        if values.min() < info.min or values.max() > info.max:
+            raise ValueError('values out of the range of {}'.format(target))
+    return pandas.arrays.IntegerArray(values.astype(target), noDat)
+
+#mask of the nodata cells of an array as read from a band (nan cells are always nodata)
+#the nodata value is compared at the precision of the data type of the array
+def _nodataMask(data, nodata):
+    if data.dtype.kind in 'fc':
+        mask = numpy.isnan(data)
+    else:
+        mask = numpy.zeros(data.shape, dtype=bool)
+    if nodata is None or numpy.isnan(nodata):
+        return mask
+    if data.dtype.kind in 'iu':
+        # a nodata value that the integer type cannot hold never matches
+        info = numpy.iinfo(data.dtype)
+        if nodata != int(nodata) or not info.min <= nodata <= info.max:
+            return mask
+    return mask | (data == numpy.array(nodata).astype(data.dtype))
+
+#a set of co-registered rasters opened once as the bands of an in-memory VRT
+#all rasters must share size, geotransform and projection; band 1 of each raster is used
+#read() returns the same window of all layers as a 3-D array (layer, row, column)
+#mmap: read uncompressed GeoTIFFs through read-only memory maps instead of GDAL (see mapRaster)
+#nWorkers: read the metadata of the rasters with that many threads (see prefetchRasters)
+class RasterStack:
+    def __init__(self, rasterFiles, names = None, mmap = False, nWorkers = None):
+        if not rasterFiles:
+            raise ValueError('RasterStack needs at least one raster')
+        self.files = list(rasterFiles)
+        self.names = list(names) if names is not None else [os.path.splitext(os.path.basename(f))[0] for f in self.files]
+        if len(self.names) != len(self.files):
+            raise ValueError('RasterStack got {} names for {} rasters'.format(len(self.names), len(self.files)))
+
+        with profileStage('RasterStack', 'open'):
+            self._open(mmap, nWorkers)
+
+    def _open(self, mmap, nWorkers):
+        # only the (cached) metadata is read here, the datasets are opened when the layers are read
+        infos = prefetchRasters(self.files, nWorkers)
+        self.nodata = []
+        # numpy type of each layer, reads of layers of different types are promoted to a common type
+        self.dtypes = []
+        for i, (f, info) in enumerate(zip(self.files, infos)):
+            if info is None:
+                raise ValueError('could not open raster {}'.format(f))
+            self.nodata.append(info['nodata'])
+            self.dtypes.append(numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(info['dataType'])))
+            if i == 0:
+                self.geoTransform = info['geoTransform']
+                self.projection = info['projection']
+                self.xSize, self.ySize = info['xSize'], info['ySize']
+                self.blockSize = info['blockSize']
+                srs = osr.SpatialReference()
+                srs.ImportFromWkt(self.projection)
+            else:
+                self._checkAligned(f, info, srs)
+
+        # one VRT band per raster, read in one pass; built on the first read that needs it
+        self.vrt = None
+        # the memory maps are only used when all layers can be mapped
+        self.maps = None
+        if mmap:
+            maps = [mapRaster(f) for f in self.files]
+            if all(m is not None for m in maps):
+                self.maps = maps
+
+    def _checkAligned(self, f, info, srs):
+        if (info['xSize'], info['ySize']) != (self.xSize, self.ySize):
+            raise ValueError('{} has size {}x{}, expected {}x{}'.format(f, info['xSize'], info['ySize'], self.xSize, self.ySize))
+        # allow for rounding in the stored geotransforms
+        tol = abs(self.geoTransform[1])*1e-6
+        if not numpy.allclose(info['geoTransform'], self.geoTransform, rtol = 0, atol = tol):
+            raise ValueError('{} is not aligned with {}'.format(f, self.files[0]))
+        otherSrs = osr.SpatialReference()
+        otherSrs.ImportFromWkt(info['projection'])
+        if not srs.IsSame(otherSrs):
+            raise ValueError('{} has a different projection than {}'.format(f, self.files[0]))
+
+    def __len__(self):
+        return len(self.files)
+
+    def read(self, xoff = 0, yoff = 0, xsize = None, ysize = None):
+        xsize = self.xSize - xoff if xsize is None else xsize
+        ysize = self.ySize - yoff if ysize is None else ysize
+        with profileStage('RasterStack', 'read') as st:
+            if self.maps is not None:
+                data = numpy.stack([m.read(xoff, yoff, xsize, ysize) for m in self.maps])
+            else:
+                if self.vrt is None:
+                    self.vrt = gdal.BuildVRT('', self.files, separate = True)
+                data = self.vrt.ReadAsArray(xoff, yoff, xsize, ysize)
+            st.count(data)
+        # a single layer comes back as a 2-D array
+        return data.reshape(len(self.files), ysize, xsize)
+
+    # values of all layers at the given pixel indices (inside the rasters) as (layer, point), memory mapped layers only
+    def sample(self, rows, cols):
+        with profileStage('RasterStack', 'read') as st:
+            values = numpy.stack([m.sample(rows, cols) for m in self.maps])
+            st.count(values)
+        return values
+
+    def close(self):
+        self.vrt = None
+        self.maps = None
+
+
+#one window reader with the RasterStack interface for a single band
+def _bandReader(band):
+    def read(xoff, yoff, xsize, ysize):
+        with profileStage('getValuesAtPoint', 'read') as st:
+            data = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            st.count(data)
+        return data[numpy.newaxis]
+    return read
+
+#read only the native blocks (tiles or strips) that contain points
+#adjacent blocks are merged into one read as long as the window fits in maxMemory bytes
+#read returns 3-D (layer, row, column) windows, the result is (layer, point)
+def _sampleBlocks(read, xSize, ySize, blockSize, rows, cols, maxMemory = None, nLayers = 1):
+    bx, by = blockSize
+    nBlockCols = int(math.ceil(xSize / bx))
+    blockRows = rows // by
+    blockCols = cols // bx
+    # visit the points block by block
+    keys = blockRows * nBlockCols + blockCols
+    order = numpy.argsort(keys, kind='stable')
+    uniq, starts = numpy.unique(keys[order], return_index=True)
+    ends = numpy.append(starts[1:], len(order))
+
+    # group the touched blocks in runs of adjacent blocks
+    runs = []
+    for k, s, e in zip(uniq, starts, ends):
+        br, bc = divmod(int(k), nBlockCols)
+        if runs:
+            r0, c0, r1, c1, s0, _ = runs[-1]
+            if nBlockCols == 1:
+                adjacent, nRows, nCols = br == r1 + 1, br - r0 + 1, 1
+            else:
+                adjacent, nRows, nCols = br == r1 and bc == c1 + 1, 1, bc - c0 + 1
+            if adjacent and maxMemory and nRows*by * nCols*bx * 8*nLayers <= maxMemory:
+                runs[-1] = [r0, c0, br, bc, s0, e]
+                continue
+        runs.append([br, bc, br, bc, s, e])
+
+    values = None
+    for r0, c0, r1, c1, s, e in runs:
+        xoff, yoff = c0*bx, r0*by
+        xcount = min((c1 + 1)*bx, xSize) - xoff
+        ycount = min((r1 + 1)*by, ySize) - yoff
+        data = read(xoff, yoff, xcount, ycount)
+        if values is None:
+            values = numpy.empty((data.shape[0],) + rows.shape, dtype=data.dtype)
+        idx = order[s:e]
+        values[:, idx] = data[:, rows[idx] - yoff, cols[idx] - xoff]
+        del data
+    return values
+
+#gather values at the given pixel indices
+#returns one column per layer (see _valueColumn) with nodata and out of bounds points masked, and the mask of points inside the raster
+#by default one window spanning all the points is read; with blockRead, or when that window
+#would exceed maxMemory bytes, only the blocks that contain points are read
+#sample: function returning the (layer, point) values at pixel indices directly (memory mapped rasters)
+#dtypes: type of the column of each layer (see _valueColumn)
+def _samplePixels(read, xSize, ySize, blockSize, nodata, rows, cols, blockRead = False, maxMemory = None, sample = None, dtypes = None):
+    inside = (rows >= 0) & (rows < ySize) & (cols >= 0) & (cols < xSize)
+    # no point inside: all values are masked
+    v = numpy.zeros((len(nodata), 0))
+    if inside.any():
+        r, c = rows[inside], cols[inside]
+        yoff, xoff = int(r.min()), int(c.min())
+        xcount, ycount = int(c.max()) - xoff + 1, int(r.max()) - yoff + 1
+        if sample is not None:
+            v = sample(r, c)
+        elif blockRead or (maxMemory and xcount*ycount*8*len(nodata) > maxMemory):
+            v = _sampleBlocks(read, xSize, ySize, blockSize, r, c, maxMemory, len(nodata))
+        else:
+            # read only the window that spans the points inside the raster
+            data = read(xoff, yoff, xcount, ycount)
+            v = data[:, r - yoff, c - xoff]
+            del data
+    columns = []
+    for b, nd in enumerate(nodata):
+        vb = numpy.zeros(rows.shape, dtype=v.dtype)
+        vb[inside] = v[b]
+        noDat = ~inside
+        noDat[inside] = _nodataMask(v[b], nd)
+        columns.append(_valueColumn(vb, noDat, dtypes[b] if dtypes else None))
+    return columns, inside
+
+def _sampleBand(band, rows, cols, blockRead = False, maxMemory = None, rasterMap = None, dtype = None):
+    if dtype == 'native':
+        # the type of the band, also when no point is inside it
+        dtype = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    sample = None
+    if rasterMap is not None:
+        def sample(r, c):
+            with profileStage('getValuesAtPoint', 'read') as st:
+                v = rasterMap.sample(r, c)
+                st.count(v)
+            return v[numpy.newaxis]
+    values, inside = _samplePixels(_bandReader(band), band.XSize, band.YSize, band.GetBlockSize(),
+                                   [band.GetNoDataValue()], rows, cols, blockRead, maxMemory, sample, [dtype])
+    return values[0], inside
+
+#indir: directory of the {name}.tif rasters in rasterfileList, or a RasterStack
+#with a RasterStack all layers are sampled in one pass; rasterfileList then selects layers by name (None for all)
+#blockRead: read only the raster blocks that contain points instead of one window around all points
+#maxMemory: cap (in bytes) of the pixel data read at once per raster, implies blockRead when exceeded
+#mmap: sample uncompressed GeoTIFFs through read-only memory maps, only the pages of the touched pixels are read
+#(for a RasterStack, create it with mmap = True)
+#dtype: data type of the value columns, None for float64 with nan, 'native' to keep the type of each raster,
+#or a compact type such as 'float32' or 'int16'; nodata is nan for float and missing (pandas Int16 etc) for integer types
+#coords: cell columns as 'string' (Xc, Yc '{:.6f}' strings), 'float' (Xc, Yc) or 'index' (raster col and row)
+#nWorkers: number of threads opening and sampling rasters concurrently (see mapRasters), columns keep the list order
+#maxInFlight: maximum number of rasters being sampled or waiting to be added to the table (2*nWorkers by default)
+def getValuesAtPoint(indir, rasterfileList, pos, lon='x', lat='y', sp = '', blockRead = False, maxMemory = None, mmap = False,
+                     dtype = None, coords = 'string', nWorkers = None, maxInFlight = None):
     #gt(2) and gt(4) coefficients are zero, and the gt(1) is pixel width, and gt(5) is pixel height.
     #The (gt(0),gt(3)) position is the top left corner of the top left pixel of the raster.
-    for i, rs in enumerate(rasterfileList):
-        print('processing {}'.format(rs))
-        presValues = []
-        gdata = gdal.Open('{}/{}.tif'.format(indir,rs))
-        gt = gdata.GetGeoTransform()
-        band = gdata.GetRasterBand(1)
-        nodata = band.GetNoDataValue()
-
-        x0, y0 , w , h = gt[0], gt[3], abs(gt[1]), abs(gt[5])
-        
-        xmin, xmax, ymin, ymax = min(pos[lon]), max(pos[lon]), min(pos[lat]), max(pos[lat])
-
-        # Specify offset and rows and columns to read
-        xoff = int((xmin - x0)/w)
-        yoff = int((y0 - ymax)/h)
-        xcount = int(math.ceil((xmax - xmin)/w)+1)
-        ycount = int(math.ceil((ymax - ymin)/h)+1)
+    xs = pos[lon].to_numpy()
+    ys = pos[lat].to_numpy()
+
+    if isinstance(indir, RasterStack):
+        stack = indir
+        gt = stack.geoTransform
+        rows, cols = _coordsToPixels(gt, xs, ys)
+        values, keep = _samplePixels(stack.read, stack.xSize, stack.ySize, stack.blockSize, stack.nodata,
+                                     rows, cols, blockRead, maxMemory, stack.sample if stack.maps else None,
+                                     stack.dtypes if dtype == 'native' else [dtype]*len(stack))
+        df = _pointFrame(pos, xs, ys, sp, gt, rows, cols, keep, coords)
+        for rs in (stack.names if rasterfileList is None else rasterfileList):
+            df[rs] = values[stack.names.index(rs)][keep]
+        logger.info('extracted values written in dataframe')
+        return df
+
+    paths = ['{}/{}.tif'.format(indir,rs) for rs in rasterfileList]
+    results = mapRasters(_samplePoints, paths, nWorkers, (xs, ys, blockRead, maxMemory, mmap, dtype), maxInFlight)
+    for i, (rs, (path, (gt, rows, cols, values, inside))) in enumerate(zip(rasterfileList, results)):
+        logger.info('processing {}'.format(rs))
+        if i == 0:
+            # points outside the first raster are dropped
+            keep = inside
+            df = _pointFrame(pos, xs, ys, sp, gt, rows, cols, keep, coords)
+        df[rs] = values[keep]
+    logger.info('extracted values written in dataframe')
+    return df
 
-        if xoff + xcount > gdata.RasterXSize:
-            xoff = 0
-            xcount = gdata.RasterXSize
+#sample one raster at the points, in a worker of mapRasters
+def _samplePoints(gdata, path, xs, ys, blockRead, maxMemory, mmap, dtype):
+    rasterMap = mapRaster(path) if mmap else None
+    gt = gdata.GetGeoTransform()
+    band = gdata.GetRasterBand(1)
 
-        if yoff + ycount > gdata.RasterYSize:
-            yoff = 0
-            ycount = gdata.RasterYSize
+    # pixel indices of all points at once
+    rows, cols = _coordsToPixels(gt, xs, ys)
+    values, inside = _sampleBand(band, rows, cols, blockRead, maxMemory, rasterMap, dtype)
+    return gt, rows, cols, values, inside
 
-        data = band.ReadAsArray(xoff, yoff, xcount, ycount).astype(numpy.float)
-        #free memory
-        del gdata
-        
-        if i == 0:
-            #iterate through the points
-            for p in pos.iterrows():
-                x = int((p[1][lon] - x0)/w) - xoff
-                Xc = x0 + int((p[1][lon] - x0)/w)*w + w/2 #the cell center x
-                y = int((y0 - p[1][lat])/h) - yoff
-                Yc = y0 - int((y0 - p[1][lat])/h)*h - h/2 #the cell center y
-                try:
-                    if data[y,x] != nodata:
-                        value = data[y,x]
-                    else:
-                        value = numpy.nan
-
-                    if sp:
-                        presVAL = [p[1][sp],p[1][lon],p[1][lat], '{:.6f}'.format(Xc), '{:.6f}'.format(Yc), value]
-                    else:
-                        presVAL = [1,p[1][lon],p[1][lat], '{:.6f}'.format(Xc), '{:.6f}'.format(Yc), value]
-                    presValues.append(presVAL)
-                except:
-                    pass
-            df = pandas.DataFrame(presValues, columns=['sp', 'x', 'y', 'Xc', 'Yc', rs])
-        else:
-            #iterate through the points
-            for p in pos.iterrows():
-                x = int((p[1][lon] - x0)/w) - xoff
-                y = int((y0 - p[1][lat])/h) - yoff
-                try:
-                    if data[y,x] != nodata:
-                        presValues.append(data[y,x])
-                    else:
-                        presValues.append(numpy.nan)
-                except:
-                    pass
-            df[rs] = pandas.Series(presValues)
-    del data, band
-    print('extracted values written in dataframe')
-    return df
+#the point columns of the getValuesAtPoint table
+def _pointFrame(pos, xs, ys, sp, gt, rows, cols, keep, coords = 'string'):
+    cells = _cellColumns(gt, rows[keep], cols[keep], coords)
+    columns = {'sp': pos[sp].to_numpy()[keep] if sp else 1, 'x': xs[keep], 'y': ys[keep]}
+    columns.update(cells)
+    return pandas.DataFrame(columns, columns=['sp', 'x', 'y'] + list(cells))
 
 
 #### function to get all pixel center coordinates and corresponding values from rasters
-def getRasterValues(indir, rasterfileList, skipNoData = True):
-    
-    for i, rs in enumerate(rasterfileList):
+#indir: directory of the {name}.tif rasters in rasterfileList, or a RasterStack (rasterfileList then selects layers, None for all)
+#the rasters must share the same grid; the first one defines the rows of the table
+#with skipNoData only its cells with data are returned, nodata cells of the other rasters are returned as nan
+#chunkSize: number of raster rows per chunk, if given a generator of one DataFrame per row block is returned
+#mmap: read uncompressed GeoTIFFs through read-only memory maps (for a RasterStack, create it with mmap = True)
+#dtype, coords: types of the value columns and form of the cell columns, see getValuesAtPoint
+#nWorkers: number of threads opening the rasters, and reading and tabulating row blocks concurrently (see mapBlocks),
+#chunks keep their order; maxInFlight: maximum number of blocks being read or waiting to be consumed (2*nWorkers by default)
+def getRasterValues(indir, rasterfileList, skipNoData = True, chunkSize = None, mmap = False, dtype = None, coords = 'string',
+                    nWorkers = None, maxInFlight = None):
+    if isinstance(indir, RasterStack):
+        stack = indir
+    else:
+        for rs in rasterfileList:
+            logger.info('processing {}'.format(rs))
+        stack = RasterStack(['{}/{}.tif'.format(indir,rs) for rs in rasterfileList], rasterfileList, mmap, nWorkers)
+    names = stack.names if rasterfileList is None else list(rasterfileList)
 
-        print('processing {}'.format(rs))
-        
-        if i == 0:
-            vList = []
-            gdata = gdal.Open('{}/{}.tif'.format(indir,rs))
-            gt = gdata.GetGeoTransform()
-            band = gdata.GetRasterBand(1)
-            nodata = band.GetNoDataValue()
-            if not nodata: #if there's no data defined, assign a very small number
-                nodata = -3.402823e+38 
-            data = band.ReadAsArray().astype(numpy.float)
-            #free memory
-            del gdata
-
-            x0, y0 , w , h = gt[0], gt[3], gt[1], gt[5]
-
-            for r, row in enumerate(data):
-                x = 0
-                for c, column in enumerate(row):
-                    if skipNoData == True:
-                        if '{:0.3e}'.format(column) == '{:0.3e}'.format(nodata): #if value is no data (I reduced it to three digits to avoid conflicts)
-                            pass
-                        else:
-                            x = x0 + c*w + w/2
-                            y = y0 + r*h + h/2
-                            vList.append(['{:.6f}'.format(x),'{:.6f}'.format(y),column])
-                    elif skipNoData == False:
-                        if '{:0.3e}'.format(column) == '{:0.3e}'.format(nodata):
-                            column = numpy.nan
-                        x = x0 + c*w + w/2
-                        y = y0 + r*h + h/2
-                        vList.append(['{:.6f}'.format(x),'{:.6f}'.format(y),column])
-                        
-            df = pandas.DataFrame(vList, columns=['Xc', 'Yc', rs])
-            
-        else:
-            gdata = gdal.Open('{}/{}.tif'.format(indir,rs))
-            gt = gdata.GetGeoTransform()
-            band = gdata.GetRasterBand(1)
-            nodata = band.GetNoDataValue()
-            if not nodata: #if there's no data defined, assign a very small number
-                nodata = -3.402823e+38
-            data = band.ReadAsArray().astype(numpy.float)
-            #free memory
-            del gdata
-            if skipNoData == True: 
-                vList = [c for r in data for c in r if '{:0.3e}'.format(c) == '{:0.3e}'.format(nodata)]
-            elif skipNoData == False:
-                vList = [c if '{:0.3e}'.format(c) != '{:0.3e}'.format(nodata) else numpy.nan for r in data for c in r]
-                
-            df[rs] = pandas.Series(vList)
-    
-    del data, band
-    
-    print('extracted values written in dataframe')   
+    chunks = _iterRasterValues(stack, names, skipNoData, chunkSize, dtype, coords, nWorkers, maxInFlight)
+    if chunkSize:
+        return chunks
+
+    df = pandas.concat(list(chunks), ignore_index=True)
+    logger.info('extracted values written in dataframe')
     return(df)
 
+def _iterRasterValues(stack, names, skipNoData, chunkSize, dtype = None, coords = 'string', nWorkers = None, maxInFlight = None):
+    layers = [stack.names.index(rs) for rs in names]
+    nodata = []
+    for l in layers:
+        nd = stack.nodata[l]
+        if nd is None: #if there's no data defined, use the lowest float32 number
+            nd = -numpy.finfo(numpy.float32).max
+        nodata.append(nd)
+
+    gt = stack.geoTransform
+    ncols, nrows = stack.xSize, stack.ySize
+    dtypes = [stack.dtypes[l] if dtype == 'native' else dtype for l in layers]
+    xName, yName = ('col', 'row') if coords == 'index' else ('Xc', 'Yc')
+    cellType = object if coords == 'string' else None
+    # the column centers are the same for every row block
+    xc = numpy.array(_cellColumns(gt, numpy.zeros(ncols), numpy.arange(ncols), coords)[xName], dtype=cellType)
+    if not chunkSize:
+        # strips of whole native blocks, about 4 million cells each
+        by = stack.blockSize[1]
+        chunkSize = max(by, (2**22 // max(ncols, 1)) // by * by)
+        if nWorkers:
+            # at least one block per worker
+            chunkSize = min(chunkSize, max(by, int(math.ceil(nrows / (nWorkers*by)))*by))
+
+    # strips of whole rows of all layers, read and tabulated in the pool
+    blocks = rasterBlocks(ncols, nrows, (ncols, chunkSize))
+    files = [stack.files[l] for l in layers]
+    results = mapBlocks(_valueFrameBlock, blocks, files, nWorkers, mmap = stack.maps is not None, maxInFlight = maxInFlight,
+                        args = (nodata, names, (xName, xc), yName, cellType, gt, coords, skipNoData, dtypes))
+    for block, df in results:
+        yield df
+
+def _valueFrameBlock(data, block, nodata, names, xc, yName, cellType, gt, coords, skipNoData, dtypes):
+    yc = numpy.array(_cellColumns(gt, numpy.arange(block.yoff, block.yoff + block.ysize), numpy.zeros(block.ysize), coords)[yName], dtype=cellType)
+    with profileStage('getRasterValues', 'compute') as st:
+        df = _valueFrame(data, range(len(names)), nodata, names, xc, (yName, yc), skipNoData, dtypes)
+        st.count(data)
+    return df
+
+#table of the cells of one window of the layers of a stack
+#xc, yc: (name, values) of the cell columns of the columns and rows of the window
+def _valueFrame(data, layers, nodata, names, xc, yc, skipNoData, dtypes = None):
+    columns = {}
+    for i, (l, nd) in enumerate(zip(layers, nodata)):
+        noDat = _nodataMask(data[l], nd)
+        if i == 0:
+            # cells of the chunk that end up in the table
+            if skipNoData:
+                r, c = numpy.nonzero(~noDat)
+            else:
+                r, c = numpy.indices(noDat.shape).reshape(2, -1)
+            columns[xc[0]] = xc[1][c]
+            columns[yc[0]] = yc[1][r]
+        columns[names[i]] = _valueColumn(data[l, r, c], noDat[r, c], dtypes[i] if dtypes else None)
+        del noDat
+    return pandas.DataFrame(columns, columns=[xc[0], yc[0]] + names)
+
 
 # geo raster to numpy array    
-def raster2array(rasterfn):
-    raster = gdal.Open(rasterfn)
+# mmap: for uncompressed GeoTIFFs, read the array from a memory map of the file: a read-only view without
+# any copy for contiguous striped files, one copy (assembled tile by tile) otherwise; other rasters are read through GDAL
+def raster2array(rasterfn, mmap = False):
+    raster = openRaster(rasterfn)
+    info = rasterInfo(rasterfn)
     band = raster.GetRasterBand(1)
-    nodata = band.GetNoDataValue()
-    array = band.ReadAsArray()
+    nodata = info['nodata']
+    rasterMap = mapRaster(rasterfn) if mmap else None
+    with profileStage('raster2array', 'read') as st:
+        array = rasterMap.read() if rasterMap is not None else band.ReadAsArray()
+        st.count(array)
     
-    proj = raster.GetProjection()
     inproj = osr.SpatialReference()
-    inproj.ImportFromWkt(proj)
+    inproj.ImportFromWkt(info['projection'])
     
-    geoTransform = raster.GetGeoTransform()
+    geoTransform = info['geoTransform']
     minx = geoTransform[0]
     maxy = geoTransform[3]
-    maxx = minx + geoTransform[1]*raster.RasterXSize
-    miny = maxy + geoTransform[5]*raster.RasterYSize
+    maxx = minx + geoTransform[1]*info['xSize']
+    miny = maxy + geoTransform[5]*info['ySize']
     extent =  [minx, maxx, miny, maxy]
     pixelSizeXY = [geoTransform[1], geoTransform[5]]
     del raster, band
     return [array, nodata, extent, inproj, pixelSizeXY]
 
 #clip a raster by vector
-def clipRaster(raster, newRaster, vector):
-    raster = gdal.Open(raster)
-    
+#cells not touched by the features of the vector are set to the nodata value of the raster
+def clipRaster(raster, newRaster, vector, creationOptions = None, cog = False, nWorkers = None):
+    clipRasters([raster], [newRaster], vector, creationOptions, cog, nWorkers)
+
+#clip many rasters by the same vector
+#the vector is rasterized only once for all the rasters that share the same grid (and kept in the mask cache, see vectorMask)
+#creationOptions, cog: see writeRaster
+#nWorkers: number of threads clipping the native blocks of a raster concurrently (see mapBlocks)
+def clipRasters(rasterList, newRasterList, vector, creationOptions = None, cog = False, nWorkers = None):
     vect = ogr.Open(vector)
     lyr = vect.GetLayer()
     ext = lyr.GetExtent()
-    
-    gTrans = raster.GetGeoTransform()
-    #get the x start of the left most pixel
-    xlP = int((ext[0] - gTrans[0])/gTrans[1])*gTrans[1] - abs(gTrans[0])
-    #get the x end of the right most pixel
-    xrP = math.ceil((ext[1] - gTrans[0])/gTrans[1])*gTrans[1] - abs(gTrans[0])
-    #get the y start of the upper most pixel
-    yuP = abs(gTrans[3]) - int((gTrans[3] - ext[3])/gTrans[5])*gTrans[5]
-    #get the y end of the lower most pixel
-    ylP = abs(gTrans[3]) - math.floor((gTrans[3] - ext[2])/gTrans[5])*gTrans[5]
-        
-    gdal.Translate('tmp.tif', raster, projWin = [xlP, yuP, xrP, ylP])
-    del raster
-    tRas = gdal.Open('tmp.tif')
-    band = tRas.GetRasterBand(1)
-    noDat = band.GetNoDataValue()
-    # store a copy before rasterize
-    fullRas = band.ReadAsArray().astype(numpy.float)
-    
-    gdal.RasterizeLayer(tRas, [1], lyr, None, None, [-9999], ['ALL_TOUCHED=TRUE']) # now tRas is modified
-    
-    finRas = tRas.GetRasterBand(1).ReadAsArray().astype(numpy.float)
 
-    for i, row in enumerate(finRas):
-        for j, col in enumerate(row):
-            if col == -9999.:
-                finRas[i, j] = fullRas[i, j]
-            else:
-                finRas[i, j] = noDat
+    for raster, newRaster in zip(rasterList, newRasterList):
+        with profileStage('clipRasters', 'open'):
+            info = rasterInfo(raster)
+        gTrans = info['geoTransform']
+        #pixel window around the vector extent
+        colL = math.floor((ext[0] - gTrans[0])/gTrans[1])
+        colR = math.ceil((ext[1] - gTrans[0])/gTrans[1])
+        rowU = math.floor((gTrans[3] - ext[3])/abs(gTrans[5]))
+        rowL = math.ceil((gTrans[3] - ext[2])/abs(gTrans[5]))
+        window = (colL, rowU, colR - colL, rowL - rowU)
+        winTrans = (gTrans[0] + colL*gTrans[1], gTrans[1], 0, gTrans[3] + rowU*gTrans[5], 0, gTrans[5])
+
+        # cells of the window outside the raster are read as its nodata value (0 without one), like gdal.Translate
+        noDat = info['nodata']
+        fill = 0 if noDat is None else noDat
+        if noDat is None:
+            noDat = -9999
+
+        mask = vectorMask(vector, winTrans, window[2], window[3], info['projection'])
+
+        blocks = rasterBlocks(info['xSize'], info['ySize'], _workBlockSize(info['blockSize'], window[2]), window = window)
+        results = mapBlocks(_clipBlock, blocks, [raster], nWorkers, args = (mask, noDat), fill = fill)
+        writeRaster(newRaster, ((block.outXoff, block.outYoff, values) for block, values in results), winTrans,
+                    info['projection'], noDat, "float32", creationOptions, cog, shape = (window[3], window[2]))
+
+def _clipBlock(data, block, mask, noDat):
+    inside = mask[block.outYoff:block.outYoff + block.ysize, block.outXoff:block.outXoff + block.xsize]
+    return numpy.where(inside, data[0], noDat)
+
+#statistics of the cells of a raster (band 1) per feature of a vector file
+#the feature ids are rasterized once onto the raster grid (in memory, or a temporary file for large rasters) and the
+#statistics are accumulated block by block, so the memory stays bounded for rasters larger than memory
+#stats: any of 'count', 'sum', 'mean', 'min', 'max', 'std' (population); nodata and nan cells are ignored
+#idField: attribute identifying the features (the index of the result), the feature ids (fid) by default
+#allTouched: count all cells touched by a feature instead of the cells whose center is inside it
+#overlapping (e.g. nested) features are rasterized in separate layers, so their shared cells count for each of them
+#nWorkers: number of threads reading and accumulating blocks concurrently (see mapBlocks)
+def zonalStats(raster, vector, stats = ('mean', 'min', 'max', 'sum', 'count'), idField = None, allTouched = False, nWorkers = None):
+    for stat in stats:
+        if stat not in ('count', 'sum', 'mean', 'min', 'max', 'std'):
+            raise ValueError("unknown statistic '{}'".format(stat))
+    with profileStage('zonalStats', 'open'):
+        info = rasterInfo(raster)
+        srcVector = ogr.Open(vector)
+        srcLayer = srcVector.GetLayer()
 
-    array2raster(newRaster, 'tmp.tif', finRas, noDat, "float32")
-    os.remove('tmp.tif')
-    del fullRas, finRas, band, tRas
+    # copies of the features with their zone number (1..n, 0 is outside the features) as attribute,
+    # in as many layers as needed for the features of a layer not to overlap
+    with profileStage('zonalStats', 'compute') as st:
+        zoneVector = ogr.GetDriverByName('Memory').CreateDataSource('')
+        zoneLayers = []
+        keys = []
+        # with allTouched, features less than a cell diagonal apart can touch the same cells
+        cell = math.hypot(info['geoTransform'][1], info['geoTransform'][5]) if allTouched else 0
+        for feature in srcLayer:
+            keys.append(feature.GetField(idField) if idField else feature.GetFID())
+            geom = feature.GetGeometryRef()
+            z = 0
+            while z < len(zoneLayers) and zoneLayers[z].overlaps(geom, cell):
+                z += 1
+            if z == len(zoneLayers):
+                zoneLayers.append(_ZoneLayer(zoneVector, srcLayer.GetSpatialRef(), z))
+            zoneLayers[z].add(geom, len(keys))
+        st.count(pixels = len(keys))
+    if len(zoneLayers) > 1:
+        logger.info('overlapping features rasterized in {} layers'.format(len(zoneLayers)))
+
+    nZones = len(keys) + 1
+    count = numpy.zeros(nZones, dtype=numpy.int64)
+    total = numpy.zeros(nZones)
+    squares = numpy.zeros(nZones)
+    low = numpy.full(nZones, numpy.inf)
+    high = numpy.full(nZones, -numpy.inf)
+
+    zoneRasters = []
+    try:
+        for zoneLayer in zoneLayers:
+            zoneRasters.append(_rasterizeZones(zoneLayer.layer, info, allTouched))
+        blocks = rasterBlocks(info['xSize'], info['ySize'], _workBlockSize(info['blockSize'], info['xSize']))
+        dtype = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(info['dataType']))
+        results = mapBlocks(_zoneBlock, blocks, [raster] + zoneRasters, nWorkers, args = (dtype, info['nodata'], 'std' in stats))
+        for block, (zones, n, s, s2, mn, mx) in results:
+            count[zones] += n
+            total[zones] += s
+            squares[zones] += s2
+            low[zones] = numpy.minimum(low[zones], mn)
+            high[zones] = numpy.maximum(high[zones], mx)
+    finally:
+        for zoneRaster in zoneRasters:
+            clearCache(zoneRaster)
+            gdal.GetDriverByName('GTiff').Delete(zoneRaster)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        columns = {'count': count, 'sum': total, 'mean': mean,
+                   'min': numpy.where(count > 0, low, numpy.nan), 'max': numpy.where(count > 0, high, numpy.nan),
+                   'std': numpy.sqrt(numpy.maximum(squares / count - mean**2, 0))}
+    df = pandas.DataFrame({stat: columns[stat][1:] for stat in stats}, index = pandas.Index(keys, name = idField or 'fid'))
+    return df
+
+#in-memory layer of zones that do not share cells
+class _ZoneLayer:
+    def __init__(self, zoneVector, srs, index):
+        self.layer = zoneVector.CreateLayer('zones{}'.format(index), srs, ogr.wkbUnknown)
+        self.layer.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+        self.geoms = []
+        # envelopes (xmin, xmax, ymin, ymax) of the geometries, grown by doubling
+        self.envelopes = numpy.empty((16, 4))
+
+    # whether a geometry may share cells with a zone of the layer
+    # cell: diagonal of a cell when all touched cells are rasterized (features closer than it may touch the same cell),
+    # 0 when only the cells whose center is inside a feature are (features that only touch share no cell)
+    def overlaps(self, geom, cell = 0):
+        if geom is None or not self.geoms:
+            return False
+        e = self.envelopes[:len(self.geoms)]
+        xmin, xmax, ymin, ymax = geom.GetEnvelope()
+        candidates = numpy.nonzero((e[:, 0] <= xmax + cell) & (e[:, 1] >= xmin - cell) &
+                                   (e[:, 2] <= ymax + cell) & (e[:, 3] >= ymin - cell))[0]
+        for i in candidates:
+            other = self.geoms[i]
+            if cell:
+                if geom.Distance(other) < cell:
+                    return True
+            elif geom.Intersects(other) and not geom.Touches(other):
+                return True
+        return False
+
+    def add(self, geom, zoneNumber):
+        if geom is not None:
+            if len(self.geoms) == len(self.envelopes):
+                self.envelopes = numpy.concatenate([self.envelopes, numpy.empty_like(self.envelopes)])
+            self.envelopes[len(self.geoms)] = geom.GetEnvelope()
+            self.geoms.append(geom.Clone())
+        zone = ogr.Feature(self.layer.GetLayerDefn())
+        zone.SetGeometry(geom)
+        zone.SetField('zone', zoneNumber)
+        self.layer.CreateFeature(zone)
+
+# GTiff of the zone numbers of a layer on the grid of a raster, in memory (/vsimem/) up to 256 MB, else a temporary file
+# the file is removed again if the rasterization fails
+def _rasterizeZones(zoneLayer, info, allTouched):
+    if info['xSize']*info['ySize']*4 <= 2**28:
+        path = '/vsimem/zones_{}.tif'.format(uuid.uuid4().hex)
+    else:
+        fd, path = tempfile.mkstemp(suffix = '.tif')
+        os.close(fd)
+    try:
+        with profileStage('zonalStats', 'compute') as st:
+            zoneRaster = gdal.GetDriverByName('GTiff').Create(path, info['xSize'], info['ySize'], 1, gdal.GDT_Int32,
+                                                              ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+            zoneRaster.SetGeoTransform(info['geoTransform'])
+            if info['projection']:
+                zoneRaster.SetProjection(info['projection'])
+            gdal.RasterizeLayer(zoneRaster, [1], zoneLayer, options = ['ATTRIBUTE=zone', 'ALL_TOUCHED={}'.format('TRUE' if allTouched else 'FALSE')])
+            zoneRaster.FlushCache()
+            del zoneRaster
+            st.count(pixels = info['xSize']*info['ySize'])
+    except Exception:
+        if gdal.VSIStatL(path) is not None:
+            gdal.Unlink(path)
+        raise
+    return path
+
+# count, sum, sum of squares, min and max of the cells of a block per zone found in it
+#data: the raster and the zone layers; the values come back in the type of the raster, for the nodata comparison
+def _zoneBlock(data, block, dtype, nodata, squares):
+    values = data[0].astype(dtype)
+    hasData = ~_nodataMask(values, nodata)
+    zones, cells = [], []
+    for layer in data[1:]:
+        layer = layer.astype(numpy.int64)
+        valid = (layer > 0) & hasData
+        zones.append(layer[valid])
+        cells.append(values[valid])
+    zones, inverse = numpy.unique(numpy.concatenate(zones), return_inverse = True)
+    values = numpy.concatenate(cells).astype(numpy.float64)
+    n = numpy.bincount(inverse, minlength = len(zones))
+    s = numpy.bincount(inverse, values, minlength = len(zones))
+    s2 = numpy.bincount(inverse, values*values, minlength = len(zones)) if squares else 0
+    mn = numpy.full(len(zones), numpy.inf)
+    mx = numpy.full(len(zones), -numpy.inf)
+    numpy.minimum.at(mn, inverse, values)
+    numpy.maximum.at(mx, inverse, values)
+    return zones, n, s, s2, mn, mx
+
+# processing blocks of whole native blocks (tiles or strips) of about cells pixels, at most the raster width
+def _workBlockSize(blockSize, xSize, cells = 2**22):
+    bx, by = blockSize
+    width = min(max(bx, (cells // by) // bx * bx), int(math.ceil(xSize / bx))*bx)
+    height = max(by, (cells // width) // by * by)
+    return width, height
 
 # create a reference raster with random values    
-# create a reference raster with random values    
+# cellValues: 'random' (integers in [0, 1000), reproducible with seed), 'lat' (row index), 'lon' (column index) or 'index'
+# the raster is computed and written block by block, so grids larger than memory can be created
+# nWorkers: number of threads computing blocks concurrently (see mapBlocks), the values do not depend on it
 def createRaster(outRas, xmin, ymin, xmax, ymax, pixelSize, coordinates = 'spherical', 
                  proj = '+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs', 
                  cellValues = 'random', dataType = "float32", noData = -9999, 
-                 inVector = None, rasterizeOptions = ['ALL_TOUCHED=FALSE']):
+                 inVector = None, rasterizeOptions = ['ALL_TOUCHED=FALSE'], seed = None,
+                 creationOptions = ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'], cog = False, overviews = None, nWorkers = None):
     
-    NP2GDAL_CONVERSION = { "uint8": 1, "uint16": 2, "int16": 3, 
-                          "uint32": 4, "int32": 5, "float32": 6, "float64": 7,
-                          "complex64": 10, "complex128": 11,
-                         }
     if os.path.exists(outRas):
-        print('Raster file already excists!')
+        logger.warning('Raster file already excists!')
         return
     
     if coordinates == 'spherical':
-        # create coordinate transformation
-        inRef = osr.SpatialReference()
-        inRef.ImportFromProj4('+proj=longlat +datum=WGS84 +no_defs +ellps=WGS84 +towgs84=0,0,0')
-        outRef = osr.SpatialReference()
-        outRef.ImportFromProj4(proj)
-
-        coordTransform = osr.CoordinateTransformation(inRef, outRef)
-
-        LLpoint = ogr.Geometry(ogr.wkbPoint)
-        LLpoint.AddPoint(float(xmin), float(ymin))
-        LLpoint.Transform(coordTransform)
-        URpoint = ogr.Geometry(ogr.wkbPoint)
-        URpoint.AddPoint(float(xmax), float(ymax))
-        URpoint.Transform(coordTransform)
-        xmin, ymin, xmax, ymax = LLpoint.GetX(), LLpoint.GetY(), URpoint.GetX(), URpoint.GetY(),
+        # transform the lower left and upper right corners
+        xs, ys = reprojectPoints('+proj=longlat +datum=WGS84 +no_defs +ellps=WGS84 +towgs84=0,0,0', proj,
+                                 [xmin, xmax], [ymin, ymax])
+        xmin, ymin, xmax, ymax = float(xs[0]), float(ys[0]), float(xs[1]), float(ys[1])
         
     # Create the destination data source        
-    xRes = int(numpy.int((xmax - xmin) / pixelSize))
-    yRes = int(numpy.int((ymax - ymin) / pixelSize))
+    xRes = int((xmax - xmin) / pixelSize)
+    yRes = int((ymax - ymin) / pixelSize)
     
-    targetRas = gdal.GetDriverByName('GTiff').Create(outRas, xRes, yRes, 1, NP2GDAL_CONVERSION[dataType])
-    targetRas.SetGeoTransform((xmin, pixelSize, 0, ymax, 0, -pixelSize))
-    band = targetRas.GetRasterBand(1)
-    band.SetNoDataValue(noData)
-
-    if inVector != None:
-        srcVector = ogr.Open(inVector)
-        srcLayer = srcVector.GetLayer()
-        
-        # Rasterize clips the raster band
-        gdal.RasterizeLayer(targetRas, [1], srcLayer, None, None, [0], rasterizeOptions)
-
-        g = band.ReadAsArray()
+    targetRasSRS = osr.SpatialReference()
+    targetRasSRS.ImportFromProj4(proj)
 
-    else:
-        g = numpy.zeros((yRes,xRes), eval('numpy.{}'.format(dataType)))
+    # strips of whole rows, about 16 million cells (and whole 256 row tiles) at a time
+    blockRows = 256
+    chunkRows = max(blockRows, (2**24 // max(xRes, 1)) // blockRows * blockRows)
+    blocks = list(rasterBlocks(xRes, yRes, (xRes, chunkRows)))
+    # one random stream per block, the values only depend on the seed, not on the order the blocks are computed in
+    seeds = numpy.random.SeedSequence(seed).spawn(len(blocks))
+
+    # the mask of the whole grid is cached when it fits in the mask cache (see vectorMask), else every block rasterizes its part
+    mask = None
+    if inVector is not None and xRes*yRes <= maskFunc.maxMaskBytes:
+        mask = vectorMask(inVector, (xmin, pixelSize, 0, ymax, 0, -pixelSize), xRes, yRes, None, rasterizeOptions)
+
+    results = mapBlocks(_createRasterBlock, blocks, None, nWorkers,
+                        args = (xmin, ymax, pixelSize, xRes, cellValues, dataType, noData, inVector, rasterizeOptions, seeds, mask))
+    writeRaster(outRas, ((block.yoff, g) for block, g in results), (xmin, pixelSize, 0, ymax, 0, -pixelSize),
+                targetRasSRS.ExportToWkt(), noData, dataType, creationOptions, cog, overviews, (yRes, xRes))
+    logger.info('raster file created!')
+
+def _createRasterBlock(data, block, xmin, ymax, pixelSize, xRes, cellValues, dataType, noData, inVector, rasterizeOptions, seeds, mask):
+    with profileStage('createRaster', 'compute') as st:
+        g = _createRasterValues(xmin, ymax, pixelSize, xRes, block.yoff, block.ysize, cellValues, dataType, noData,
+                                inVector, rasterizeOptions, numpy.random.default_rng(seeds[block.index]), mask)
+        st.count(g)
+    return g
+
+def _createRasterValues(xmin, ymax, pixelSize, xRes, yoff, ycount, cellValues, dataType, noData, inVector, rasterizeOptions, rng, mask = None):
+    cols = numpy.arange(xRes)
+    rows = numpy.arange(yoff, yoff + ycount)[:, numpy.newaxis]
 
     #populate matrix with numbers
-    for i in range(yRes):
-        for j in range(xRes):
-            if g[i,j] != noData:
-                if cellValues == 'lat':
-                    g[i,j] = i
-                elif cellValues == 'lon':
-                    g[i,j] = j
-                elif cellValues == 'random':
-                    g[i,j] = numpy.random.randint(1000)
-                elif cellValues == 'index':
-                    g[i,j] = i*xRes + j
-
-    band.WriteArray(g)
-    targetRasSRS = osr.SpatialReference()
-    targetRasSRS.ImportFromProj4(proj)
-    targetRas.SetProjection(targetRasSRS.ExportToWkt())
-    band.FlushCache()
-    print('raster file created!')
+    if cellValues == 'lat':
+        g = numpy.broadcast_to(rows, (ycount, xRes))
+    elif cellValues == 'lon':
+        g = numpy.broadcast_to(cols, (ycount, xRes))
+    elif cellValues == 'random':
+        g = rng.integers(1000, size=(ycount, xRes))
+    elif cellValues == 'index':
+        g = rows*xRes + cols
+    else:
+        g = numpy.zeros((ycount, xRes))
+    g = g.astype(dataType)
+
+    # rasterizing the vector clips the raster
+    if mask is not None:
+        g[~mask[yoff:yoff + ycount]] = noData
+    elif inVector is not None:
+        # not cached, every block opens its own layer
+        srcVector = ogr.Open(inVector)
+        blockTrans = (xmin, pixelSize, 0, ymax - yoff*pixelSize, 0, -pixelSize)
+        g[~_rasterizeMask(srcVector.GetLayer(), blockTrans, xRes, ycount, None, rasterizeOptions)] = noData
+    return g
 
 #function to filter raster cells based on the coverage by some vector features
-def filterByCoverage(vectorFile, rasterFile, covPerc):
-    
+#cells covered by more than covPerc percent are set to nan
+#nProcesses: see coverageFraction
+def filterByCoverage(vectorFile, rasterFile, covPerc, nProcesses = None):
+    coverage = coverageFraction(vectorFile, rasterFile, nProcesses)
+
+    array = raster2array(rasterFile)[0]
+    if array.dtype.kind not in 'fc':
+        array = array.astype(numpy.float64)
+    array[coverage*100 > covPerc] = numpy.nan
+    return(array) #return the filtered array
+
+#fraction (0 to 1) of the area of each raster cell covered by the features of a vector file, as a read-only array
+#areas are computed exactly in the raster's coordinates, the vector must be in the same projection
+#the fractions are cached per vector and grid like the masks of vectorMask
+#the rows are processed in bands of bandRows rows (about 4 million cells by default), which bounds the memory
+#nProcesses: process the bands in a process pool
+def coverageFraction(vectorFile, rasterFile, nProcesses = None, bandRows = None):
+    info = rasterInfo(rasterFile)
+    gt = info['geoTransform']
+    nrows, ncols = info['ySize'], info['xSize']
+
+    def compute():
+        with profileStage('coverageFraction', 'compute') as st:
+            rings = _pixelRings(vectorFile, gt)
+            blocks = rasterBlocks(ncols, nrows, (ncols, bandRows or _bandRows(nrows, ncols, nProcesses)))
+            # the sweep is pure python, processes run it in parallel
+            results = mapBlocks(_coverageBlock, blocks, None, nProcesses, useProcesses = True, args = (rings,))
+            coverage = mergeBlocks(results, ncols, nrows)
+            st.count(coverage)
+        return coverage
+    return cachedArray('coverage', vectorFile, (tuple(gt), ncols, nrows), compute)
+
+def _coverageBlock(data, block, rings):
+    return _coverageBand(rings, block.yoff, block.yoff + block.ysize, block.xsize)
+
+# rows per band: about 4 million cells, and at least 4 bands per process
+def _bandRows(nrows, ncols, nProcesses, cells = 2**22):
+    rows = cells // max(ncols, 1)
+    if nProcesses and nProcesses > 1:
+        rows = min(rows, int(math.ceil(nrows / (nProcesses*4))))
+    return max(rows, 1)
+
+# rings of the merged features in pixel coordinates (column, row)
+def _pixelRings(vectorFile, gt):
+    return [((x - gt[0])/gt[1], (y - gt[3])/gt[5], sign) for x, y, sign in _vectorRings(vectorFile)]
+
+#rings of the union of all features of a vector file as (x, y, sign) with sign 1 for shells and -1 for holes
+def _vectorRings(vectorFile):
     srcVector = ogr.Open(vectorFile)
     srcLayer = srcVector.GetLayer()
-    # merge all features in one geometry (multi polygone)
-    multi  = ogr.Geometry(ogr.wkbMultiPolygon)
+    # merge all features in one geometry (multi polygone), overlaps are counted once
+    multi = ogr.Geometry(ogr.wkbMultiPolygon)
     for feature in srcLayer:
         geom = feature.GetGeometryRef()
-        multi.AddGeometry(geom)
-    
-    #attributes of raster file
-    rasList = raster2array(rasterFile)
-
-    xsize = rasList[4][0]
-    ysize = abs(rasList[4][1])
-
-    pixel_area = xsize*ysize
-
-    rows = rasList[0].shape[0]
-    cols = rasList[0].shape[1]
-
-    x1 = rasList[2][0]
-    y1 = rasList[2][3]
-    
-    #iterate over raster cells
-    for i in range(rows):
-        for j in range(cols):
-            ring = ogr.Geometry(ogr.wkbLinearRing)
-
-            ring.AddPoint(x1, y1)
-            ring.AddPoint(x1 + xsize, y1)
-            ring.AddPoint(x1 + xsize, y1 - ysize)
-            ring.AddPoint(x1, y1 - ysize)
-            ring.AddPoint(x1, y1)
-
-            poly = ogr.Geometry(ogr.wkbPolygon)
-            poly.AddGeometry(ring)
-
-            intersect = multi.Intersection(poly)
-
-            if intersect.ExportToWkt() != 'GEOMETRYCOLLECTION EMPTY':
-                perc = (intersect.GetArea()/pixel_area)*100
-                if perc > covPerc:
-                    rasList[0][i][j] = numpy.nan     
-            x1 += xsize
-        x1 = rasList[2][0]
-        y1 -= ysize
-    
-    return(rasList[0]) #return the filtered array
-
+        if geom is None:
+            continue
+        geom = ogr.ForceToMultiPolygon(geom)
+        for i in range(geom.GetGeometryCount()):
+            multi.AddGeometry(geom.GetGeometryRef(i))
+    union = ogr.ForceToMultiPolygon(multi.UnionCascaded())
+
+    rings = []
+    for i in range(union.GetGeometryCount()):
+        poly = union.GetGeometryRef(i)
+        for j in range(poly.GetGeometryCount()):
+            points = numpy.array(poly.GetGeometryRef(j).GetPoints(), dtype=numpy.float64)
+            if len(points) > 2:
+                rings.append((points[:, 0], points[:, 1], 1 if j == 0 else -1))
+    del srcVector
+    return rings
+
+#coverage (float32) of the rows r0 to r1 of a grid with ncols columns by rings in pixel coordinates
+def _coverageBand(rings, r0, r1, ncols):
+    coverage = numpy.zeros((r1 - r0, ncols))
+    for u, v, sign in rings:
+        # only the cells inside the bounding box of the ring
+        c0, c1 = max(int(math.floor(u.min())), 0), min(int(math.ceil(u.max())), ncols)
+        y0, y1 = max(int(math.floor(v.min())), r0), min(int(math.ceil(v.max())), r1)
+        if c0 >= c1 or y0 >= y1:
+            continue
+        area = _ringCoverage(u - c0, v - y0, y1 - y0, c1 - c0)
+        # orient the ring so that shells add and holes subtract area
+        orientation = numpy.sum((u[1:] - u[:-1])*(v[1:] + v[:-1]))
+        area *= sign*numpy.sign(orientation)
+        coverage[y0 - r0:y1 - r0, c0:c1] += area
+        del area
+    return numpy.clip(coverage, 0, 1, out=coverage).astype(numpy.float32)
+
+#integer values strictly between a and b (per edge) within [lo, hi], as (edge index, position t along the edge)
+def _edgeCrossings(a, b, lo, hi):
+    start = numpy.maximum(numpy.floor(numpy.minimum(a, b)) + 1, lo)
+    end = numpy.minimum(numpy.ceil(numpy.maximum(a, b)) - 1, hi)
+    count = numpy.maximum(end - start + 1, 0).astype(numpy.int64)
+    edge = numpy.repeat(numpy.arange(len(a)), count)
+    k = start[edge] + (numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(count) - count, count))
+    return edge, (k - a[edge]) / (b[edge] - a[edge])
+
+#signed area of a closed ring inside each cell of a nrows x ncols grid in pixel coordinates
+#for every vertical line the area below each edge is clamped to the cell rows, so the edges are
+#split at the grid lines and each piece adds a trapezoid to its cell and full cells to the cells above it
+def _ringCoverage(u, v, nrows, ncols):
+    ua, ub, va, vb = u[:-1], u[1:], v[:-1], v[1:]
+    # edges above the grid add nothing
+    below = (va > 0) | (vb > 0)
+    ua, ub, va, vb = ua[below], ub[below], va[below], vb[below]
+    n = len(ua)
+    eu, tu = _edgeCrossings(ua, ub, 0, ncols)
+    ev, tv = _edgeCrossings(va, vb, 0, nrows)
+    edge = numpy.concatenate([numpy.arange(n), numpy.arange(n), eu, ev])
+    t = numpy.concatenate([numpy.zeros(n), numpy.ones(n), tu, tv])
+    order = numpy.lexsort((t, edge))
+    edge, t = edge[order], t[order]
+    pu = ua[edge] + t*(ub - ua)[edge]
+    # rows outside the grid add nothing (above) or full cells (below)
+    pv = numpy.clip(va[edge] + t*(vb - va)[edge], 0, nrows)
+
+    piece = edge[1:] == edge[:-1]
+    du = (pu[1:] - pu[:-1])[piece]
+    um = ((pu[1:] + pu[:-1])/2)[piece]
+    vm = ((pv[1:] + pv[:-1])/2)[piece]
+    col = numpy.floor(um).astype(numpy.int64)
+    row = numpy.minimum(numpy.floor(vm).astype(numpy.int64), nrows)
+    ok = (col >= 0) & (col < ncols) & (du != 0)
+    du, vm, col, row = du[ok], vm[ok], col[ok], row[ok]
+
+    # full cells: every row above the piece, summed bottom up
+    # bincount of no pieces (a ring outside the columns of the grid) comes back as int64
+    full = numpy.bincount(row*ncols + col, weights=du, minlength=(nrows + 1)*ncols).astype(numpy.float64, copy=False)
+    full = full.reshape(nrows + 1, ncols)
+    full = numpy.cumsum(full[::-1], axis=0)[::-1][1:]
+    # partial cell: the trapezoid between the piece and the top of its row
+    inGrid = row < nrows
+    full += numpy.bincount(row[inGrid]*ncols + col[inGrid], weights=du[inGrid]*(vm[inGrid] - row[inGrid]),
+                           minlength=nrows*ncols).reshape(nrows, ncols)
+    return full
 
 # numpy array to geo raster
-def array2raster(newRaster, RefRaster, array, noData, dataType):
+# array: 2-D array, 3-D (band, row, column) array for a multi band raster, or an iterator of
+# (row offset, block) pairs written block by block; the size is then taken from the reference raster
+# creationOptions, cog, overviews: see writeRaster
+def array2raster(newRaster, RefRaster, array, noData, dataType, creationOptions = None, cog = False, overviews = None):
+    #get info from reference raster
+    rfInfo = rasterInfo(RefRaster)
+    shape = None if isinstance(array, numpy.ndarray) else (rfInfo['ySize'], rfInfo['xSize'])
+    writeRaster(newRaster, array, rfInfo['geoTransform'], rfInfo['projection'], noData, dataType,
+                creationOptions, cog, overviews, shape)
+
+#GTiff creation options for tiled, compressed output
+#predictor: 2 (horizontal differencing) for integer data, 3 (floating point) for float data
+#bigTiff: 'YES', 'NO', 'IF_NEEDED' or 'IF_SAFER'
+def tiffOptions(tiled = True, compress = 'DEFLATE', predictor = None, bigTiff = 'IF_SAFER', blockSize = 256):
+    options = []
+    if tiled:
+        options += ['TILED=YES', 'BLOCKXSIZE={}'.format(blockSize), 'BLOCKYSIZE={}'.format(blockSize)]
+    if compress:
+        options.append('COMPRESS={}'.format(compress))
+    if predictor:
+        options.append('PREDICTOR={}'.format(predictor))
+    if bigTiff:
+        options.append('BIGTIFF={}'.format(bigTiff))
+    return options
+
+#write data to a GeoTIFF with the given geotransform and projection (wkt)
+#data: 2-D array, 3-D (band, row, column) array, or an iterator of (row offset, block) pairs where
+#the blocks are 2-D or 3-D arrays of whole rows, or of (column offset, row offset, block) triples;
+#shape (rows, columns) or (bands, rows, columns) is then required
+#creationOptions: GTiff creation options (see tiffOptions), plain striped GTiff by default
+#cog: write a Cloud Optimized GeoTIFF with internal overviews (GDAL >= 3.1)
+#overviews: overview levels (e.g. [2, 4, 8, 16]) built with overviewResampling for a plain GTiff
+#bandNames: band descriptions
+def writeRaster(newRaster, data, geoTransform, projection, noData, dataType, creationOptions = None,
+                cog = False, overviews = None, shape = None, bandNames = None, overviewResampling = 'NEAREST'):
     #data type conversion
     NP2GDAL_CONVERSION = { "uint8": 1, "int8": 1, "uint16": 2, "int16": 3, 
                           "uint32": 4, "int32": 5, "float32": 6, "float64": 7,
                           "complex64": 10, "complex128": 11,
                          }
-    #get info from reference raster
-    rfRaster = gdal.Open(RefRaster)
-    geotransform = rfRaster.GetGeoTransform()
-    originX = geotransform[0]
-    originY = geotransform[3]
-    pixelWidth = geotransform[1]
-    pixelHeight = geotransform[5]
-    cols = array.shape[1]
-    rows = array.shape[0]
-    #create new raster
-    outRaster = gdal.GetDriverByName('GTiff').Create(newRaster, cols, rows,1, NP2GDAL_CONVERSION[dataType])
-    outRaster.SetGeoTransform((originX, pixelWidth, 0, originY, 0, pixelHeight))
-    #write array to band
-    outband = outRaster.GetRasterBand(1)
-    outband.SetNoDataValue(noData)
-    outband.WriteArray(array)
+    if isinstance(data, numpy.ndarray):
+        shape = data.shape
+        data = [(0, data)]
+    if len(shape) == 2:
+        shape = (1,) + tuple(shape)
+    nBands, rows, cols = shape
+    creationOptions = list(creationOptions or [])
+
+    #create new raster, dropping any cached handle of a file it replaces
+    clearCache(newRaster)
+    target = newRaster
+    if cog:
+        # the COG driver can only copy a complete dataset
+        target = newRaster + '.tmp.tif'
+        tmpOptions = ['TILED=YES', 'COMPRESS=DEFLATE', 'ZLEVEL=1', 'BIGTIFF=IF_SAFER']
+    outRaster = gdal.GetDriverByName('GTiff').Create(target, cols, rows, nBands, NP2GDAL_CONVERSION[dataType],
+                                                     tmpOptions if cog else creationOptions)
+    outRaster.SetGeoTransform((geoTransform[0], geoTransform[1], 0, geoTransform[3], 0, geoTransform[5]))
     #define new raster projection
     outRasterSRS = osr.SpatialReference()
-    outRasterSRS.ImportFromWkt(rfRaster.GetProjectionRef())
+    outRasterSRS.ImportFromWkt(projection)
     outRaster.SetProjection(outRasterSRS.ExportToWkt())
+    for b in range(nBands):
+        outband = outRaster.GetRasterBand(b + 1)
+        outband.SetNoDataValue(noData)
+        if bandNames is not None:
+            outband.SetDescription(str(bandNames[b]))
+
+    #write blocks to bands
+    for item in data:
+        xoff, yoff, block = item if len(item) == 3 else (0,) + tuple(item)
+        if block.ndim == 2:
+            block = block[numpy.newaxis]
+        with profileStage('writeRaster', 'write') as st:
+            for b in range(nBands):
+                outRaster.GetRasterBand(b + 1).WriteArray(block[b], xoff, yoff)
+            st.count(block)
+
+    if overviews and not cog:
+        with profileStage('writeRaster', 'compute'):
+            outRaster.BuildOverviews(overviewResampling, list(overviews))
     #write raster
-    outband.FlushCache()
-    del rfRaster
-    
-
-    
- 
\ No newline at end of file
+    with profileStage('writeRaster', 'write'):
+        outRaster.FlushCache()
+
+    if cog:
+        # tiling is implied, the block size option is called BLOCKSIZE
+        cogOptions = [o for o in creationOptions if o.split('=')[0].upper() not in ('TILED', 'BLOCKXSIZE', 'BLOCKYSIZE')]
+        with profileStage('writeRaster', 'write'):
+            gdal.GetDriverByName('COG').CreateCopy(newRaster, outRaster, options = cogOptions)
+        del outRaster
+        gdal.GetDriverByName('GTiff').Delete(target)
+    else:
+        del outRaster
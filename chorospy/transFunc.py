@@ -1,51 +1,163 @@
-from osgeo import gdal, osr, ogr
+from osgeo import gdal, osr
 import numpy
-import subprocess
-import re
-
-def rasterToJSON (infile, outfile):
-    #get projection of input file
-    inProj = subprocess.Popen(['gdalsrsinfo', infile, '-o', 'proj4'], stdout=subprocess.PIPE, encoding='utf8').stdout.read().strip().replace('\'','')
-    #get info of input file
-    inFo = subprocess.Popen(['gdalinfo', infile], stdout=subprocess.PIPE, encoding='utf8').stdout.read().split('\n')
-    coordDic = {}
-
-    for i in ['Upper Left', 'Lower Left', 'Upper Right', 'Lower Right', 'Center']:
-        pp = [x for x in inFo if i in x]
-        PP = re.split(r'\(|\)', pp[0])[1].strip().replace(' ', '').split(',')
-        #transform to wgs84
-        p = subprocess.Popen(['gdaltransform', '-s_srs', inProj, '-t_srs', 'EPSG:4326'], stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8')
-        pointCoord = p.communicate('{} {}'.format(PP[0], PP[1]))[0].rstrip().split()
-        
-        try:
-            x, y = float(pointCoord[0]), float(pointCoord[1])
-            coordDic[i] = [x,y]
-        except:
-            coordDic[i] = []
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from .cacheFunc import openRaster
+from .profileFunc import profileStage
 
-        
+logger = logging.getLogger(__name__)
+
+# coordinate transformations of the current thread (they are not thread-safe), least recently used last out
+maxTransforms = 128
+_transforms = threading.local()
 
-    inRas = gdal.Open(infile)
+# write the first band of a raster as json for the web viewer
+# corner coordinates are given in WGS84 and nodata cells are written as -9999
+# precision: number of decimals of the values (default: shortest exact representation)
+# binary: write the values as raw little endian float32 in a .bin sidecar file next to the json header
+def rasterToJSON (infile, outfile, precision = None, binary = False, blockRows = 256):
+    with profileStage('rasterToJSON', 'open'):
+        inRas = openRaster(infile)
     
     nrows = inRas.RasterYSize
     ncols = inRas.RasterXSize
+    inProj = _proj4(inRas)
+    coordDic = _wgs84Corners(inProj, [inRas.GetGeoTransform()], [ncols], [nrows])[0]
     
     band1 = inRas.GetRasterBand(1)
     nodata = band1.GetNoDataValue()
-    gdata = band1.ReadAsArray()
-    
-    dataType = gdal.GetDataTypeName(band1.DataType)
-    #convert to float
-    if dataType.startswith('Int'):
-        gdata = gdata.astype(numpy.float32, copy=False)
-    # new nodata value
-    gdata[gdata == nodata] = -9999
-    gdata[numpy.isnan(gdata)]= -9999
+    blocks = (_jsonBlock(_readRows(band1, yoff, ncols, min(blockRows, nrows - yoff)), nodata)
+              for yoff in range(0, nrows, blockRows))
+    _writeJSON(outfile, coordDic, inProj, ncols, nrows, blocks, precision, binary)
 
-    #gdata = numpy.concatenate(gdata)
-    #gdata = gdata.tolist()
-    #write to json
-    
+def _readRows(band, yoff, ncols, nrows):
+    with profileStage('rasterToJSON', 'read') as st:
+        data = band.ReadAsArray(0, yoff, ncols, nrows)
+        st.count(data)
+    return data
+
+# export a raster as a pyramid of tiles for web viewers
+# every zoom level halves the resolution of the next one, down to a single tile at zoom 0;
+# each tile is written to {outdir}/{zoom}/{x}_{y}.json in the rasterToJSON layout and
+# {outdir}/index.json describes the levels
+# resampling: 'mean' (nodata is ignored) or 'mode' for categorical rasters
+# with incremental, only the tiles whose source pixels changed since the last export are written again
+def rasterToTiles(infile, outdir, tileSize = 256, resampling = 'mean', precision = None, binary = False, incremental = True):
+    with profileStage('rasterToTiles', 'open'):
+        inRas = openRaster(infile)
+    nrows, ncols = inRas.RasterYSize, inRas.RasterXSize
+    gt = inRas.GetGeoTransform()
+    inProj = _proj4(inRas)
+    band1 = inRas.GetRasterBand(1)
+    nodata = band1.GetNoDataValue()
+    resampleAlg = {'mean': gdal.GRIORA_Average, 'mode': gdal.GRIORA_Mode}[resampling]
+
+    # levels from full resolution (factor 1) to one tile
+    maxZoom = 0
+    while max(ncols, nrows) > tileSize * 2**maxZoom:
+        maxZoom += 1
+    index = {'source': os.path.basename(infile), 'width': ncols, 'height': nrows, 'geoTransform': list(gt),
+             'projEPSG': inProj, 'tileSize': tileSize, 'resampling': resampling, 'precision': precision,
+             'format': 'bin' if binary else 'json', 'levels': [], 'checksums': {}}
+
+    # checksums of the full resolution tiles of the previous export
+    indexFile = os.path.join(outdir, 'index.json')
+    previous = {}
+    if incremental and os.path.exists(indexFile):
+        with open(indexFile) as fp:
+            old = json.load(fp)
+        if all(old.get(k) == index[k] for k in index if k not in ('levels', 'checksums')):
+            previous = old['checksums']
+
+    changed = set()
+    written = 0
+    for zoom in range(maxZoom, -1, -1):
+        factor = 2**(maxZoom - zoom)
+        width, height = -(-ncols // factor), -(-nrows // factor)
+        tilesX, tilesY = -(-width // tileSize), -(-height // tileSize)
+        index['levels'].append({'zoom': zoom, 'factor': factor, 'width': width, 'height': height,
+                                'tilesX': tilesX, 'tilesY': tilesY})
+        os.makedirs(os.path.join(outdir, str(zoom)), exist_ok=True)
+
+        tiles = [(tx, ty) for ty in range(tilesY) for tx in range(tilesX)]
+        tileCols = [min(tileSize, width - tx*tileSize) for tx, ty in tiles]
+        tileRows = [min(tileSize, height - ty*tileSize) for tx, ty in tiles]
+        tileTrans = [(gt[0] + tx*tileSize*factor*gt[1], factor*gt[1], gt[2], gt[3] + ty*tileSize*factor*gt[5], gt[4], factor*gt[5])
+                     for tx, ty in tiles]
+        corners = _wgs84Corners(inProj, tileTrans, tileCols, tileRows)
+        # a coarser tile covers factor x factor full resolution tiles
+        changedTiles = set((x // factor, y // factor) for x, y in changed)
+
+        for k, (tx, ty) in enumerate(tiles):
+            tileFile = os.path.join(outdir, str(zoom), '{}_{}.json'.format(tx, ty))
+            # source window of the tile
+            xoff, yoff = tx*tileSize*factor, ty*tileSize*factor
+            xsize, ysize = min(tileSize*factor, ncols - xoff), min(tileSize*factor, nrows - yoff)
+            if factor == 1:
+                with profileStage('rasterToTiles', 'read') as st:
+                    data = band1.ReadAsArray(xoff, yoff, xsize, ysize)
+                    st.count(data)
+                key = '{}_{}'.format(tx, ty)
+                index['checksums'][key] = hashlib.blake2b(data.tobytes(), digest_size=16).hexdigest()
+                if previous.get(key) != index['checksums'][key]:
+                    changed.add((tx, ty))
+            if (tx, ty) not in (changed if factor == 1 else changedTiles) and os.path.exists(tileFile):
+                continue
+            if factor > 1:
+                with profileStage('rasterToTiles', 'read') as st:
+                    data = band1.ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize=tileCols[k], buf_ysize=tileRows[k],
+                                             resample_alg=resampleAlg)
+                    st.count(pixels = xsize*ysize, nbytes = data.nbytes)
+            _writeJSON(tileFile, corners[k], inProj, tileCols[k], tileRows[k], [_jsonBlock(data, nodata)], precision, binary,
+                       'rasterToTiles')
+            written += 1
+
+    with open(indexFile, 'w') as fp:
+        json.dump(index, fp)
+    logger.info('{} tiles written'.format(written))
+
+# proj4 string of the projection of a dataset
+def _proj4(dataset):
+    inSRS = osr.SpatialReference()
+    inSRS.ImportFromWkt(dataset.GetProjection())
+    return inSRS.ExportToProj4().strip()
+
+# corners and center of grids (geotransform, columns, rows) transformed to wgs84 in one call
+# corners that can not be transformed are empty lists
+def _wgs84Corners(inProj, geoTransforms, ncols, nrows):
+    corners = ['Upper Left', 'Lower Left', 'Upper Right', 'Lower Right', 'Center']
+    gts = numpy.asarray(geoTransforms, dtype=numpy.float64).reshape(-1, 6)
+    ncols = numpy.asarray(ncols, dtype=numpy.float64)[:, numpy.newaxis]
+    nrows = numpy.asarray(nrows, dtype=numpy.float64)[:, numpy.newaxis]
+    zero = numpy.zeros_like(ncols)
+    px = numpy.hstack([zero, zero, ncols, ncols, ncols/2])
+    py = numpy.hstack([zero, nrows, zero, nrows, nrows/2])
+    x = gts[:, 0:1] + px*gts[:, 1:2] + py*gts[:, 2:3]
+    y = gts[:, 3:4] + px*gts[:, 4:5] + py*gts[:, 5:6]
+    try:
+        xs, ys = reprojectPoints(inProj, 'EPSG:4326', x.ravel(), y.ravel())
+    except Exception:
+        xs = ys = numpy.full(x.size, numpy.nan)
+    xs, ys = xs.reshape(x.shape), ys.reshape(y.shape)
+
+    coordDics = []
+    for i in range(len(gts)):
+        coordDic = {}
+        for j, corner in enumerate(corners):
+            if numpy.isfinite(xs[i, j]) and numpy.isfinite(ys[i, j]):
+                coordDic[corner] = [float(xs[i, j]), float(ys[i, j])]
+            else:
+                coordDic[corner] = []
+        coordDics.append(coordDic)
+    return coordDics
+
+# write a json header and the blocks of rows of a grid, as json rows or as a float32 sidecar
+# the writing of the blocks is profiled as the write stage of function
+def _writeJSON(outfile, coordDic, inProj, ncols, nrows, blocks, precision = None, binary = False, function = 'rasterToJSON'):
     with open(outfile, 'w') as fp:
         fp.write('{\n')
         fp.write('"upLeft": {}'.format(coordDic['Upper Left']) + ',\n')
@@ -56,34 +168,87 @@ def rasterToJSON (infile, outfile):
         fp.write('"projEPSG": "{}"'.format(inProj) + ',\n')
         fp.write('"width": {}'.format(ncols) + ',\n')
         fp.write('"height": {}'.format(nrows) + ',\n')
+        if binary:
+            dataFile = os.path.splitext(outfile)[0] + '.bin'
+            fp.write('"dataFile": "{}"'.format(os.path.basename(dataFile)) + ',\n')
+            fp.write('"dataType": "float32"' + ',\n')
+            fp.write('"byteOrder": "little"' + '\n}\n')
+            with open(dataFile, 'wb') as fb:
+                for block in blocks:
+                    with profileStage(function, 'write') as st:
+                        block.astype('<f4', copy=False).tofile(fb)
+                        st.count(block)
+            return
+
         fp.write('"data":'+ '\n')
-        for i, row in enumerate(gdata):
-            if i == 0:
-                fp.write('[{}'.format(row.tolist()))
-            else:
-                fp.write(',\n{}'.format(row.tolist()))
+        # one format string for a whole row
+        valueFmt = '%r' if precision is None else '%.{}f'.format(precision)
+        rowFmt = '[' + ', '.join([valueFmt]*ncols) + ']'
+        for i, block in enumerate(blocks):
+            with profileStage(function, 'write') as st:
+                fp.write('[' if i == 0 else ',\n')
+                fp.write(',\n'.join([rowFmt % tuple(row) for row in block.tolist()]))
+                st.count(block)
         
-        fp.write(']\n}\n')           
-        #json.dump(gdataJSON, fp, indent=4)
-    fp.close()
+        fp.write(']\n}\n')
+
+# values of a block of rows with nodata and nan set to -9999
+def _jsonBlock(block, nodata):
+    #convert to float
+    if block.dtype.kind != 'f':
+        block = block.astype(numpy.float32)
+    # new nodata value
+    mask = numpy.isnan(block)
+    if nodata is not None:
+        mask |= block == nodata
+    block[mask] = -9999
+    return block
 
 
-# reproject a point
-def reprojectPoint(inCRS, outCRS, point):
-    inSpatialRef = osr.SpatialReference()
-    inSpatialRef.ImportFromProj4(inCRS)
+# cached coordinate transformation between two coordinate systems, one per thread
+# the CRSs can be given in any form osr understands (proj4 strings, 'EPSG:4326', wkt)
+# coordinates are always x, y (lon, lat) also with the authority axis order of GDAL 3
+def coordinateTransform(inCRS, outCRS):
+    cache = getattr(_transforms, 'cache', None)
+    if cache is None:
+        cache = _transforms.cache = OrderedDict()
+    key = (inCRS, outCRS)
+    transform = cache.get(key)
+    if transform is None:
+        transform = cache[key] = _coordinateTransform(inCRS, outCRS)
+        while len(cache) > maxTransforms:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    return transform
 
-    outSpatialRef = osr.SpatialReference()
-    outSpatialRef.ImportFromProj4(outCRS)
+def _coordinateTransform(inCRS, outCRS):
+    refs = []
+    for crs in (inCRS, outCRS):
+        ref = osr.SpatialReference()
+        ref.SetFromUserInput(crs)
+        if hasattr(ref, 'SetAxisMappingStrategy'):
+            ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        refs.append(ref)
+    return osr.CoordinateTransformation(*refs)
 
-    coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
-    
-    x = point[0]
-    y = point[1]
-    # create a geometry from coordinates
-    point = ogr.Geometry(ogr.wkbPoint)
-    point.AddPoint(float(x), float(y))
-    # transform point
-    point.Transform(coordTransform)
-
-    return [point.GetX(), point.GetY()]
\ No newline at end of file
+# reproject many points in bulk
+# x, y: arrays (or DataFrame columns) of coordinates, or x alone as an (n, 2) array
+# returns the transformed x and y as arrays
+def reprojectPoints(inCRS, outCRS, x, y = None, chunkSize = 1000000):
+    if y is None:
+        points = numpy.asarray(x, dtype=numpy.float64)[:, :2]
+    else:
+        points = numpy.column_stack([numpy.asarray(x, dtype=numpy.float64), numpy.asarray(y, dtype=numpy.float64)])
+    coordTransform = coordinateTransform(inCRS, outCRS)
+
+    out = numpy.empty((len(points), 2))
+    for i in range(0, len(points), chunkSize):
+        chunk = points[i:i + chunkSize]
+        out[i:i + len(chunk)] = numpy.array(coordTransform.TransformPoints(chunk.tolist()))[:, :2]
+    return out[:, 0], out[:, 1]
+
+# reproject a point
+def reprojectPoint(inCRS, outCRS, point):
+    x, y = reprojectPoints(inCRS, outCRS, [point[0]], [point[1]])
+    return [float(x[0]), float(y[0])]
@@ -1,8 +1,14 @@
 import os
 from osgeo import ogr, osr
-import pandas
-import random
+import numpy
 import math
+import itertools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from .transFunc import coordinateTransform, reprojectPoints
+from .profileFunc import profileStage
+
+logger = logging.getLogger(__name__)
 
 # for higher accuracy the functions below define a UTM projection based on the lon lat of a point, they are used in the pointToGeo function
 def utmGetZone(longitude):
@@ -23,12 +29,110 @@ def makeUtmCS(lon, lat):
     utmCs.SetUTM(utmZone,isNorthern)
     return utmCs
 
+# transformations between a datum (EPSG code) and the UTM zones, created once per zone
+_utmTransformCache = {}
+
+def utmTransforms(inProj, utmZone, isNorthern):
+    key = (inProj, utmZone, isNorthern)
+    if key not in _utmTransformCache:
+        inSpatialRef = osr.SpatialReference()
+        inSpatialRef.ImportFromEPSG(inProj)
+        utmCs = osr.SpatialReference()
+        utmCs.SetWellKnownGeogCS('WGS84')
+        utmCs.SetUTM(utmZone, isNorthern)
+        # points are always given as lon, lat (x, y)
+        for srs in (inSpatialRef, utmCs):
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        _utmTransformCache[key] = (osr.CoordinateTransformation(inSpatialRef, utmCs), # transform to UTM
+                               osr.CoordinateTransformation(utmCs, inSpatialRef)) # back to WGS84
+    return _utmTransformCache[key]
+
+# buffer zones of the points of one feature, returned as WKB
+# the points are grouped by UTM zone and each group is projected in one call
+# for a convex hull only the points on the convex hull of the raw points are buffered,
+# otherwise the buffers are merged with a partitioned union
+# simplify: tolerance (in units of the datum) to simplify the final geometry
+def _bufferPoints(inProj, points, bufferZone, convexHull, simplify = None):
+    points = numpy.asarray(points, dtype=numpy.float64)[:, :2]
+    if convexHull == True:
+        points = _hullPoints(points)
+    zones = (1 + (points[:, 0] + 180.0)/6.0).astype(int)
+    northern = (points[:, 1] >= 0.0).astype(int)
+
+    buffers = [None]*len(points)
+    for utmZone, isNorthern in sorted(set(zip(zones.tolist(), northern.tolist()))):
+        group = numpy.nonzero((zones == utmZone) & (northern == isNorthern))[0]
+        coordTransform, coordTransformReverse = utmTransforms(inProj, utmZone, isNorthern)
+        for k, (x, y, _) in zip(group, coordTransform.TransformPoints(points[group].tolist())):
+            utm_point = ogr.Geometry(ogr.wkbPoint)
+            utm_point.AddPoint(x, y)
+            buffPoint = utm_point.Buffer(bufferZone)
+            buffPoint.Transform(coordTransformReverse)
+            buffers[k] = buffPoint
+
+    if convexHull == True:
+        # Calculate convex hull, no union needed
+        outPoly = ogr.Geometry(ogr.wkbMultiPolygon)
+        for buffPoint in buffers:
+            outPoly.AddGeometry(buffPoint)
+        outPoly = outPoly.ConvexHull()
+    else:
+        #join overlapping polygones, neighbouring buffers first
+        order = numpy.argsort(_zOrder(points[:, 0], points[:, 1]), kind='stable')
+        outPoly = _partitionedUnion([buffers[k] for k in order])
+
+    if simplify:
+        outPoly = outPoly.SimplifyPreserveTopology(simplify)
+    return outPoly.ExportToWkb()
+
+# the points that are vertices of the convex hull of a set of points
+def _hullPoints(points):
+    if len(points) < 4:
+        return points
+    multi = ogr.Geometry(ogr.wkbMultiPoint)
+    for x, y in points.tolist():
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint(x, y)
+        multi.AddGeometry(point)
+    hull = multi.ConvexHull()
+    if hull.GetGeometryType() == ogr.wkbPolygon:
+        hull = hull.GetGeometryRef(0)
+    return numpy.array(hull.GetPoints(), dtype=numpy.float64)[:, :2]
+
+# position of points along a Z-order (Morton) curve, nearby points get nearby positions
+def _zOrder(x, y):
+    def spread(v):
+        span = v.max() - v.min()
+        v = ((v - v.min()) / (span if span > 0 else 1) * 0xFFFF).astype(numpy.uint64)
+        for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+            v = (v | (v << numpy.uint64(shift))) & numpy.uint64(mask)
+        return v
+    return spread(x) | (spread(y) << numpy.uint64(1))
+
+# union of many polygons: groups of neighbouring polygons are merged first,
+# then the partial unions are merged pairwise up a binary tree
+def _partitionedUnion(geoms, groupSize = 64):
+    parts = []
+    for i in range(0, len(geoms), groupSize):
+        multi = ogr.Geometry(ogr.wkbMultiPolygon)
+        for geom in geoms[i:i + groupSize]:
+            multi.AddGeometry(geom)
+        parts.append(multi.UnionCascaded())
+    if not parts:
+        return ogr.Geometry(ogr.wkbMultiPolygon)
+    while len(parts) > 1:
+        parts = [parts[i].Union(parts[i + 1]) if i + 1 < len(parts) else parts[i] for i in range(0, len(parts), 2)]
+    return parts[0]
+
 #########################################
 # function to produce polygons from points
 # inPoints is a list of lists e.g. [[[x1,y1], [x2,y2]], [[x3,y3], [x4,y4]]]
 # each list of points is saved as a separate feature in the final file
+# nProcesses: buffer the features in a process pool, they are still written in order
+# simplify: tolerance (in units of inProj) to simplify the buffered geometries
 #########################################
-def pointToGeo(inProj, inPoints, outFile, fields, layerName = 'Vector', buffer = False, bufferZone = 50000, convexHull = False, outFormat = 'json'):
+def pointToGeo(inProj, inPoints, outFile, fields, layerName = 'Vector', buffer = False, bufferZone = 50000, convexHull = False, outFormat = 'json', nProcesses = None, simplify = None):
     #define projections for the transformation
     inSpatialRef = osr.SpatialReference()
     inSpatialRef.ImportFromEPSG(inProj) #datum of the points
@@ -54,51 +158,37 @@ def pointToGeo(inProj, inPoints, outFile, fields, layerName = 'Vector', buffer =
         fieldType = ogr.OFTString
         propField = ogr.FieldDefn(fieldName, fieldType)
         layer.CreateField(propField)
+
+    if buffer == True:
+        # buffer all features before writing them
+        with profileStage('pointToGeo', 'compute') as st:
+            n = len(inPoints)
+            args = ([inProj]*n, inPoints, [bufferZone]*n, [convexHull]*n, [simplify]*n)
+            if nProcesses and nProcesses > 1:
+                with ProcessPoolExecutor(nProcesses) as pool:
+                    buffers = list(pool.map(_bufferPoints, *args))
+            else:
+                buffers = list(map(_bufferPoints, *args))
+            st.count(pixels = n)
         
-    for i, feat in enumerate(inPoints):
-        # create feature
-        featureIndex = i
-        feature = ogr.Feature(layerDefinition)
-        # create geometries
-        if buffer == True:
-            #create multipolygone to store buffer zones
-            outPoly = ogr.Geometry(ogr.wkbMultiPolygon)
-            for point in feat:
-                coordTransform = osr.CoordinateTransformation(inSpatialRef, makeUtmCS(point[0], point[1])) # transform to UTM
-                gps_point = ogr.Geometry(ogr.wkbPoint)
-                gps_point.AddPoint(point[0],point[1])
-                gps_point.Transform(coordTransform)
-                buffPoint = gps_point.Buffer(bufferZone)
-                coordTransformReverse = osr.CoordinateTransformation(makeUtmCS(point[0], point[1]), inSpatialRef) # back to WGS84
-                buffPoint.Transform(coordTransformReverse)
-                outPoly.AddGeometry(buffPoint)
-            
-            #join overlapping polygones
-            outPoly = outPoly.UnionCascaded()
-            if convexHull == True:
-                # Calculate convex hull
-                outPoly = outPoly.ConvexHull()
+    with profileStage('pointToGeo', 'write') as st:
+        for i, feat in enumerate(inPoints):
+            # create feature
+            featureIndex = i
+            feature = ogr.Feature(layerDefinition)
+            # create geometries
+            if buffer == True:
+                outPoly = ogr.CreateGeometryFromWkb(buffers[i])
 
-            # geometry in feature
-            feature.SetGeometry(outPoly)
-            
-            for f in range(layerDefinition.GetFieldCount()):
-                proper = layerDefinition.GetFieldDefn(f).GetName()
-                feature.SetField(proper, fields[proper][featureIndex])
-            
-            # feature in layer
-            layer.CreateFeature(feature)
+            else: #simple polygone from points
+                outPoly = ogr.Geometry(ogr.wkbPolygon)
+                ring = ogr.Geometry(ogr.wkbLinearRing)
 
-        else: #simple polygone from points
-            outPoly = ogr.Geometry(ogr.wkbPolygon)
-            ring = ogr.Geometry(ogr.wkbLinearRing)
+                for point in feat:
+                    ring.AddPoint(point[0], point[1])
 
-            for point in feat:
-                gps_point = ogr.Geometry(ogr.wkbPoint)
-                gps_point.AddPoint(point[0],point[1])
-                ring.AddPoint(gps_point.GetX(), gps_point.GetY()) #or directly ring.AddPoint(point[0], point[1])
+                outPoly.AddGeometry(ring)
 
-            outPoly.AddGeometry(ring)
             # geometry in feature
             feature.SetGeometry(outPoly)
             # add the defined properties
@@ -109,69 +199,108 @@ def pointToGeo(inProj, inPoints, outFile, fields, layerName = 'Vector', buffer =
             # feature in layer
             layer.CreateFeature(feature)
             
-        #Clean
-        outPoly.Destroy()
-        feature.Destroy()
-    shapeData.Destroy()
+            #Clean
+            outPoly.Destroy()
+            feature.Destroy()
+        shapeData.Destroy()
+        st.count(pixels = len(inPoints))
         
-    print('Geometry file created!')
+    logger.info('Geometry file created!')
         
+# mean earth radius in metres
+EARTH_RADIUS = 6371008.8
+
 #function for disaggregating occurrence points
 # distance in degrees
 # 100m = 0.001189387868; 1km = 0.008333333333333; 10km = 0.08333333333333
-def disaggregate(df,Lon, Lat, dist): 
-    train = df.drop_duplicates() #drop dublicates
-    finalDF = pandas.DataFrame(columns=[Lon, Lat])
-    removedDF = pandas.DataFrame(columns=[Lon, Lat])
-    kept = 0
-    excl = 0
-    
-    while len(train) > 1:
-        points = len(train)
-        #pick a random point in the dataset
-        i = random.randrange(0, points, 1)
-        #calculate euclidean distance between the random point and all other points (including itself)
-        eucl = ((train[Lon] - train[Lon].iloc[i])**2 + (train[Lat] - train[Lat].iloc[i])**2).apply(math.sqrt) 
-        #if there exists points with smaller distance, exclude point
-        if eucl[eucl <= dist].count() > 1:
-            excl+=1
-            exclRow = train.loc[i,]
-            removedDF = removedDF.append(exclRow, ignore_index=True)
-        else:
-            kept+=1
-            keptRow = train.loc[i,]
-            finalDF = finalDF.append(keptRow, ignore_index=True)
-
-
-        train = train.drop(train.index[i]).reset_index(drop=True)
-        
-    print('Occurences removed: %s, Occurences kept: %s' %(excl, kept))
+# the points are visited in a random order (reproducible with seed) and a point is removed
+# if a point that is visited later lies within the distance
+# greatCircle: dist is a great circle distance in metres
+def disaggregate(df,Lon, Lat, dist, seed = None, greatCircle = False): 
+    if dist <= 0:
+        raise ValueError('dist must be positive')
+    train = df.drop_duplicates().reset_index(drop=True) #drop dublicates
+    lon = train[Lon].to_numpy(dtype=numpy.float64)
+    lat = train[Lat].to_numpy(dtype=numpy.float64)
+
+    if greatCircle == True:
+        # points on the unit sphere, compared by the chord of the distance
+        lonR, latR = numpy.radians(lon), numpy.radians(lat)
+        coords = numpy.column_stack([numpy.cos(latR)*numpy.cos(lonR), numpy.cos(latR)*numpy.sin(lonR), numpy.sin(latR)])
+        threshold = 2*math.sin(min(dist/(2*EARTH_RADIUS), math.pi/2))
+    else:
+        coords = numpy.column_stack([lon, lat])
+        threshold = dist
+
+    # visiting order of every point
+    rank = numpy.random.default_rng(seed).permutation(len(train))
+    with profileStage('disaggregate', 'compute') as st:
+        kept = _thinPoints(coords, rank, threshold)
+        st.count(pixels = len(kept))
+
+    visit = numpy.argsort(rank)
+    finalDF = train.iloc[visit[kept[visit]]].reset_index(drop=True)
+    removedDF = train.iloc[visit[~kept[visit]]].reset_index(drop=True)
+
+    logger.info('Occurences removed: %s, Occurences kept: %s' %(len(removedDF), len(finalDF)))
     return(finalDF, removedDF)
 
+#points kept when every point with a closer (<= threshold) point of higher rank is removed
+#points are hashed in grid cells of threshold/sqrt(dimensions), so all points of a cell are within the threshold
+#and only the highest ranked point of each cell can be kept; it is then checked against the neighbouring cells
+def _thinPoints(coords, rank, threshold):
+    n, d = coords.shape
+    kept = numpy.zeros(n, dtype=bool)
+    if n == 0:
+        return kept
+    size = threshold/math.sqrt(d)
+    reach = int(math.ceil(math.sqrt(d)))
+    cells = numpy.floor(coords/size).astype(numpy.int64)
+    keys = numpy.ascontiguousarray(cells).view('V{}'.format(8*d)).ravel()
+
+    # points sorted by cell, highest rank first
+    order = numpy.lexsort((-rank, keys))
+    cellKeys, starts, counts = numpy.unique(keys[order], return_index=True, return_counts=True)
+    cand = order[starts]
+    kept[cand] = True
+    cellMax = rank[cand]
+
+    for offset in itertools.product(range(-reach, reach + 1), repeat=d):
+        if not any(offset):
+            continue
+        near = numpy.ascontiguousarray(cells[cand] + offset).view('V{}'.format(8*d)).ravel()
+        pos = numpy.minimum(numpy.searchsorted(cellKeys, near), len(cellKeys) - 1)
+        # neighbouring cells with a point visited after the candidate
+        check = numpy.nonzero((cellKeys[pos] == near) & (cellMax[pos] > rank[cand]) & kept[cand])[0]
+        if len(check) == 0:
+            continue
+        cnt = counts[pos[check]]
+        pc = cand[numpy.repeat(check, cnt)]
+        pj = order[numpy.repeat(starts[pos[check]], cnt) + numpy.arange(cnt.sum()) - numpy.repeat(numpy.cumsum(cnt) - cnt, cnt)]
+        close = (rank[pj] > rank[pc]) & (((coords[pj] - coords[pc])**2).sum(axis=1) <= threshold**2)
+        kept[pc[close]] = False
+    return kept
+
 
 #function for creating fishnets with centroids
-#function for creating fishnets with centroids
-def createFishNet(outFile, projection, xmin=None, ymax=None, xmax=None, ymin=None, cellWidth=None, cellHeight=None, nCols=None, nRows=None, extentIsSpherical=True, sphericalCentroid=False):
+#output format from the file extension: json, shp or gpkg
+#numericCentroids: store the centroids as real x/y columns (origX, origY, sphX, sphY) instead of '[x,y]' strings,
+#the default for gpkg; features are written in transactions of transactionSize cells
+def createFishNet(outFile, projection, xmin=None, ymax=None, xmax=None, ymin=None, cellWidth=None, cellHeight=None, nCols=None, nRows=None, extentIsSpherical=True, sphericalCentroid=False, numericCentroids=None, transactionSize=100000):
     # define projection
     out_srs = osr.SpatialReference()
     out_srs.ImportFromProj4(projection)
 
     # create coordinate transformation to WGS84
+    sphericalProj = '+proj=longlat +datum=WGS84 +no_defs +ellps=WGS84 +towgs84=0,0,0'
     sphericalSpatialRef = osr.SpatialReference()
-    sphericalSpatialRef.ImportFromProj4('+proj=longlat +datum=WGS84 +no_defs +ellps=WGS84 +towgs84=0,0,0')
-    coordTransform = osr.CoordinateTransformation(out_srs, sphericalSpatialRef)
+    sphericalSpatialRef.ImportFromProj4(sphericalProj)
+    coordTransform = coordinateTransform(projection, sphericalProj)
     
     #if extent is in spherical coordinates convert it to the defined projection
     if extentIsSpherical == True:
-        pointTransform = osr.CoordinateTransformation(sphericalSpatialRef, out_srs)
-        upLeft = ogr.Geometry(ogr.wkbPoint)
-        upLeft.AddPoint(xmin,ymax)
-        upLeft.Transform(pointTransform)
-        loRight = ogr.Geometry(ogr.wkbPoint)
-        loRight.AddPoint(xmax,ymin)
-        loRight.Transform(pointTransform)
-        
-        xmin, ymax, xmax, ymin = upLeft.GetX(), upLeft.GetY(), loRight.GetX(), loRight.GetY()
+        xs, ys = reprojectPoints(sphericalProj, projection, [xmin, xmax], [ymax, ymin])
+        xmin, ymax, xmax, ymin = float(xs[0]), float(ys[0]), float(xs[1]), float(ys[1])
             
     #define number of rows (height) and columns (width)
     rows = nRows
@@ -189,12 +318,17 @@ def createFishNet(outFile, projection, xmin=None, ymax=None, xmax=None, ymin=Non
     
     
     ####### create output file #######
-    if outFile.split('.')[-1] == 'json':
+    outFormat = outFile.split('.')[-1]
+    if outFormat == 'json':
         outDriver = ogr.GetDriverByName('GeoJSON')
-    if outFile.split('.')[-1] == 'shp':
+    if outFormat == 'shp':
         outDriver = ogr.GetDriverByName('ESRI Shapefile')
+    if outFormat == 'gpkg':
+        outDriver = ogr.GetDriverByName('GPKG')
+    if numericCentroids is None:
+        numericCentroids = outFormat == 'gpkg'
     if os.path.exists(outFile):
-        os.remove(outFile)
+        outDriver.DeleteDataSource(outFile)
     outDataSource = outDriver.CreateDataSource(outFile)
     if sphericalCentroid == False:
         outLayer = outDataSource.CreateLayer(outFile, srs = out_srs, geom_type=ogr.wkbPolygon)
@@ -203,79 +337,101 @@ def createFishNet(outFile, projection, xmin=None, ymax=None, xmax=None, ymin=Non
     
     #create field in the features' properties
     outLayer.CreateField(ogr.FieldDefn('cellID', ogr.OFTInteger))
-    outLayer.CreateField(ogr.FieldDefn('Original Centroid', ogr.OFTString))
-    if sphericalCentroid == True:
-        outLayer.CreateField(ogr.FieldDefn('Spherical Centroid', ogr.OFTString))
+    if numericCentroids:
+        centroidFields = ['origX', 'origY'] + (['sphX', 'sphY'] if sphericalCentroid else [])
+        for field in centroidFields:
+            outLayer.CreateField(ogr.FieldDefn(field, ogr.OFTReal))
+    else:
+        outLayer.CreateField(ogr.FieldDefn('Original Centroid', ogr.OFTString))
+        if sphericalCentroid == True:
+            outLayer.CreateField(ogr.FieldDefn('Spherical Centroid', ogr.OFTString))
     #create layer definition
     featureDefn = outLayer.GetLayerDefn()
     
     ###### create grid cells #######
-    # initiate first cell
-    cellLeft = xmin
-    cellRight = xmin + cellWidth
-    cellTop = ymax
-    cellBottom = ymax - cellHeight
-    cellID = 0
-    for r in range(rows):
-        
-        for c in range(cols):
-            cellID += 1
-            # create geometry
-            LRing = ogr.Geometry(ogr.wkbLinearRing)
-            LRing.AddPoint(cellLeft, cellTop)
-            LRing.AddPoint(cellRight, cellTop)
-            LRing.AddPoint(cellRight, cellBottom)
-            LRing.AddPoint(cellLeft, cellBottom)
-            LRing.AddPoint(cellLeft, cellTop)
-            poly = ogr.Geometry(ogr.wkbPolygon)
-            poly.AddGeometry(LRing)
-            # calculate original centroid
-            xOrigin = str(poly.Centroid().GetX())
-            yOrigin = str(poly.Centroid().GetY())
-            #reproject poly
+    # cells are built in blocks of whole rows, one transaction per block
+    blockRows = max(1, transactionSize // max(cols, 1))
+    xNodes = xmin + numpy.arange(cols + 1)*cellWidth
+    for r0 in range(0, rows, blockRows):
+        r1 = min(r0 + blockRows, rows)
+        with profileStage('createFishNet', 'compute') as st:
+            yNodes = ymax - numpy.arange(r0, r1 + 1)*cellHeight
+            nodeX, nodeY = numpy.meshgrid(xNodes, yNodes)
+            # original centroid of each cell
+            xOrigin = numpy.broadcast_to((xNodes[:-1] + xNodes[1:])/2, (r1 - r0, cols)).ravel().tolist()
+            yOrigin = numpy.repeat((yNodes[:-1] + yNodes[1:])/2, cols).tolist()
+            #reproject the grid nodes in one call
             if sphericalCentroid == True:
-                poly.Transform(coordTransform)
-                # calculate spherical centroid
-                x = str(poly.Centroid().GetX())
-                y = str(poly.Centroid().GetY())
-            
-            # add new geom to layer
-            outFeature = ogr.Feature(featureDefn)
-            outFeature.SetGeometry(poly)
-            # add properties
-            outFeature.SetField('cellID', cellID)
-            outFeature.SetField('Original Centroid', '[' + str(xOrigin) + ',' + str(yOrigin) + ']')
+                nodes = numpy.array(coordTransform.TransformPoints(numpy.column_stack([nodeX.ravel(), nodeY.ravel()]).tolist()))
+                nodeX = nodes[:, 0].reshape(nodeX.shape)
+                nodeY = nodes[:, 1].reshape(nodeY.shape)
+            # cell rings: upper left, upper right, lower right, lower left, upper left
+            ringX = numpy.stack([nodeX[:-1, :-1], nodeX[:-1, 1:], nodeX[1:, 1:], nodeX[1:, :-1], nodeX[:-1, :-1]], axis=-1).reshape(-1, 5)
+            ringY = numpy.stack([nodeY[:-1, :-1], nodeY[:-1, 1:], nodeY[1:, 1:], nodeY[1:, :-1], nodeY[:-1, :-1]], axis=-1).reshape(-1, 5)
             if sphericalCentroid == True:
-                outFeature.SetField('Spherical Centroid', '[' + str(x) + ',' + str(y) + ']')
+                # calculate spherical centroid
+                x, y = _ringCentroids(ringX, ringY)
+                x, y = x.tolist(), y.tolist()
+            geoms = _polygonWkb(ringX, ringY)
+            st.count(pixels = len(geoms))
 
-            outLayer.CreateFeature(outFeature)
-            outFeature.Destroy
-            
-            cellLeft += cellWidth
-            cellRight += cellWidth
-            
-        # define new row start
-        cellLeft = xmin
-        cellRight = xmin + cellWidth
-        cellTop -= cellHeight
-        cellBottom -= cellHeight
+        with profileStage('createFishNet', 'write') as st:
+            outLayer.StartTransaction()
+            for k in range(len(geoms)):
+                # add new geom to layer
+                outFeature = ogr.Feature(featureDefn)
+                outFeature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(geoms[k]))
+                # add properties
+                outFeature.SetField('cellID', r0*cols + k + 1)
+                if numericCentroids:
+                    outFeature.SetField('origX', xOrigin[k])
+                    outFeature.SetField('origY', yOrigin[k])
+                    if sphericalCentroid == True:
+                        outFeature.SetField('sphX', x[k])
+                        outFeature.SetField('sphY', y[k])
+                else:
+                    outFeature.SetField('Original Centroid', '[{},{}]'.format(xOrigin[k], yOrigin[k]))
+                    if sphericalCentroid == True:
+                        outFeature.SetField('Spherical Centroid', '[{},{}]'.format(x[k], y[k]))
+
+                outLayer.CreateFeature(outFeature)
+                outFeature = None
+            outLayer.CommitTransaction()
+            st.count(pixels = len(geoms))
                                 
     # Close DataSources
     outDataSource.Destroy()
     
     #get extent in spherical coordinates
-    upLeftSphere = ogr.Geometry(ogr.wkbPoint)
-    upLeftSphere.AddPoint(xmin,ymax)
-    upLeftSphere.Transform(coordTransform)
-    loRightSphere = ogr.Geometry(ogr.wkbPoint)
-    loRightSphere.AddPoint(xmin + cols*cellWidth, ymax - rows*cellHeight)
-    loRightSphere.Transform(coordTransform)
+    xs, ys = reprojectPoints(projection, sphericalProj, [xmin, xmin + cols*cellWidth], [ymax, ymax - rows*cellHeight])
     
     
-    print('Created grid with dimensions {} (width) x {} (height)\
+    logger.info('Created grid with dimensions {} (width) x {} (height)\
           \ncell resolution of {} x {} units\
           \nUpper Left: {} {}\
           \nLower Right: {} {}'
-          .format(cols, rows, cellWidth, cellHeight, [xmin, ymax], [upLeftSphere.GetX(), upLeftSphere.GetY()], [xmin + cols*cellWidth, ymax - rows*cellHeight], [loRightSphere.GetX(), loRightSphere.GetY()]))
+          .format(cols, rows, cellWidth, cellHeight, [xmin, ymax], [float(xs[0]), float(ys[0])], [xmin + cols*cellWidth, ymax - rows*cellHeight], [float(xs[1]), float(ys[1])]))
     
 
+#centroids of closed rings given as (ring, vertex) arrays of x and y
+def _ringCentroids(ringX, ringY):
+    cross = ringX[:, :-1]*ringY[:, 1:] - ringX[:, 1:]*ringY[:, :-1]
+    area = cross.sum(axis=1)/2
+    cx = ((ringX[:, :-1] + ringX[:, 1:])*cross).sum(axis=1)/(6*area)
+    cy = ((ringY[:, :-1] + ringY[:, 1:])*cross).sum(axis=1)/(6*area)
+    return cx, cy
+
+#little endian WKB polygons (one ring each) from (ring, vertex) arrays of x and y
+def _polygonWkb(ringX, ringY):
+    nPoints = ringX.shape[1]
+    wkb = numpy.zeros(len(ringX), dtype=[('order', 'u1'), ('type', '<u4'), ('nRings', '<u4'),
+                                          ('nPoints', '<u4'), ('xy', '<f8', (nPoints, 2))])
+    wkb['order'] = 1
+    wkb['type'] = ogr.wkbPolygon
+    wkb['nRings'] = 1
+    wkb['nPoints'] = nPoints
+    wkb['xy'][..., 0] = ringX
+    wkb['xy'][..., 1] = ringY
+    buf = wkb.tobytes()
+    size = wkb.dtype.itemsize
+    return [buf[i:i + size] for i in range(0, len(buf), size)]